@@ -51,8 +51,8 @@ mkdir -p $OUTPUTDIR
 # the input is newer than the output.
 if [ ! -e temp/agg.csv -o ! -e $OUTPATH -o "$1" -nt $OUTPATH ] ; then
 	python src/split.py "$1" temp/split.csv
-	python src/aggregate.py temp/split.csv temp/agg.csv
-	python src/aggregate.py temp/split.csv temp/agg2.csv --exclude q16
+	python src/aggregate.py temp/split.csv temp/agg.csv \
+		--profile temp/agg2.csv=q16
 else
 	echo -e "${GREEN}Skipping split/aggregation.${NOCOLOR}"
 fi
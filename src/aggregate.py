@@ -25,12 +25,21 @@ import argparse
 import codecs
 from collections import namedtuple, OrderedDict
 import csv
+from operator import itemgetter
+import os.path
 import sys
 
 from config import SKIPCOLS
+from survey_layout import SurveyLayout
 
 Aggmap = namedtuple('Aggmap', ('newcol', 'oldcols'))
 Qinfo = namedtuple('Qinfo', ('ix', 'len'))
+# gather: an itemgetter returning a source cell for each output column
+# reduce: (output column, source columns) for each aggregated answer
+RowPlan = namedtuple('RowPlan', ('gather', 'reduce'))
+# outfile: the output CSV file name
+# exclude: the questions in AGGDICT that are not to be aggregated
+Profile = namedtuple('Profile', ('outfile', 'exclude'))
 AGGLIST = [
     ('q10', [Aggmap('Not very', ('- very unsatisfied', '- 2', '- 3', '- 4',
                                  '- 5')),
@@ -87,30 +96,36 @@ def get_question_dict(qrow):
             (offset, length) where length is the number of answers to each
             question
     """
-    # qnlist is [('q1', index1), ('q2', index2), ...]
-    qnlist = [(qrow[i], i) for i in range(SKIPCOLS, len(qrow))
-              if qrow[i]]
-    qnlist.append(('qx', len(qrow)))  # append dummy entry
-    trace(2, 'qnlist: {}', qnlist)
+    layout = SurveyLayout(qrow, skipcols=SKIPCOLS)
     qdict = OrderedDict()
-    tup: tuple
-    for i, tup in enumerate(qnlist[:-1]):  # tup is (q1, index1)
-        limit = qnlist[i + 1][1]  # next question's column
-        qdict[tup[0]] = Qinfo(tup[1], limit - tup[1])
+    for question in layout:
+        qdict[question.qnum] = Qinfo(question.startcol,
+                                     question.limitcol - question.startcol)
+    trace(2, 'qdict: {}', qdict)
     return qdict
 
 
-def inv_aggdict():
+def profile_aggdict(profile):
     """
-    Convert AGGDICT to a dictionary of dictionaries where for each question the
-    keys are the original column names and the values are the aggregate column
-    names. For example, assuming we have only question 16 where AGGLIST has:
+    :param profile: a Profile
+    :return: a copy of AGGDICT without the questions excluded by the profile
+    """
+    return OrderedDict((q, anslist) for q, anslist in AGGDICT.items()
+                       if q not in profile.exclude)
+
+
+def inv_aggdict(aggdict):
+    """
+    Convert aggdict, AGGDICT or a subset of it, to a dictionary of
+    dictionaries where for each question the keys are the original column
+    names and the values are the aggregate column names. For example,
+    assuming we have only question 16 where AGGLIST has:
 
         ('q16', [Aggmap('Under 55', ('Under 16', '16 - 34', '35 - 54')),
                  Aggmap('55 or over', ('55 - 64', '65 or over')),
                  ]),
 
-    INV_AGGDICT will be:
+    the inverted dictionary will be:
 
     {'q16': {
             'Under 16': 'Under 55',
@@ -123,9 +138,9 @@ def inv_aggdict():
     :return: The inverted dictionary
     """
     invdict = OrderedDict()
-    for q in AGGDICT:
+    for q in aggdict:
         # anslist is the list of Aggmap namedtuples for this question
-        anslist = AGGDICT[q]
+        anslist = aggdict[q]
         invmap = OrderedDict()
         for amap in anslist:
             for origcol in amap.oldcols:
@@ -135,7 +150,7 @@ def inv_aggdict():
     return invdict
 
 
-def get_question_row(qrow, qdict):
+def get_question_row(qrow, qdict, aggdict):
     """
     This is used for rows 1 and 2.
     For each question, insert the question text followed by a number of empty
@@ -143,6 +158,7 @@ def get_question_row(qrow, qdict):
     in the input row or the number of aggregated answers.
     :param qrow: Row 1 or 2 as read from the CSV file
     :param qdict: The dictionary built by get_question_dict.
+    :param aggdict: AGGDICT or the subset of it to aggregate
     :return: The list with the new aggregated columns
     """
 
@@ -155,15 +171,15 @@ def get_question_row(qrow, qdict):
         ix = qinfo.ix
         length = qinfo.len
         trace(2, 'question {} len {}', question, length)
-        if question in AGGDICT:
-            length = len(AGGDICT[question])
+        if question in aggdict:
+            length = len(aggdict[question])
             trace(2, ' in AGGDICT len {}', length)
         nqr.append(qrow[ix])
         nqr += [''] * (length - 1)
     return nqr
 
 
-def new_ans_map(ansrow, qdict):
+def new_ans_map(ansrow, qdict, aggdict):
     """
     Process row #3 in the CSV file containing answer titles. Create a dict
     mapping original answer columns to aggregated answer columns. Later, when
@@ -171,20 +187,22 @@ def new_ans_map(ansrow, qdict):
     corresponding aggregated columns.
     :param ansrow: Third row of the CSV file
     :param qdict: The OrderedDict created by get_question_dict
+    :param aggdict: AGGDICT or the subset of it to aggregate
     :return: dict for ea column, the corresponding aggregated answer if one
              exists.
     """
+    invdict = inv_aggdict(aggdict)
     amap = {}
     newarow = [ansrow[i] for i in range(SKIPCOLS)]  # initialize to constants
     for question, qinf in qdict.items():
         ix = qinf.ix
         length = qinf.len
-        if question not in INV_AGGDICT:
+        if question not in invdict:
             # just copy the original questions
             newarow += ansrow[ix:ix + length]
             continue
-        oamap = INV_AGGDICT[question]  # orig ans -> agg ans
-        agdict = AGGDICT[question]  # agg ans -> orig answers
+        oamap = invdict[question]  # orig ans -> agg ans
+        agdict = aggdict[question]  # agg ans -> orig answers
         for am in agdict:  # qi is an Aggmap namedtuple
             newarow.append(am.newcol)
         # Build a dict of original column offset -> agg column name. amap will
@@ -201,40 +219,119 @@ def new_ans_map(ansrow, qdict):
     return amap, newarow
 
 
-def new_data_row(row, qdict, namap):
+def new_row_plan(qdict, namap, aggdict):
     """
+    Compile the mapping from the data rows to the aggregated rows once, so
+    that new_data_row does no dictionary lookups.
 
-    :param row: the next data row
-    :param qdict: created by get_question_row
+    :param qdict: created by get_question_dict
     :param namap: created by new_ans_map
-    :return: the newly constructed row with aggregated answers
+    :param aggdict: AGGDICT or the subset of it to aggregate
+    :return: a RowPlan. Each output column that is copied is gathered from
+             its source column. Each aggregated answer is gathered from its
+             first source column, if any, and then replaced by reduce.
     """
-    newrow = [row[i] for i in range(SKIPCOLS)]  # initialize to constant cols
+    sources = list(range(SKIPCOLS))  # the constant cols
+    reduce = []
     for question, qinf in qdict.items():
         ix = qinf.ix
         length = qinf.len
-        if question not in AGGDICT:
-            newrow += row[ix:ix + length]
+        if question not in aggdict:
+            sources += range(ix, ix + length)
             continue
-        aggd = AGGDICT[question]
-        nansdict = OrderedDict([(ad.newcol, '') for ad in aggd])
-        trace(3, 'nansdict: {}', nansdict)
-        for coln in range(ix, ix + length):
-            try:
-                newans = namap[coln]
-            except KeyError:
-                # This column in the original file is being dropped - it does
-                # not have an entry in this question's Aggmap.
-                continue  # skip this column
+        for aggmap in aggdict[question]:
+            oldcols = tuple(coln for coln in range(ix, ix + length)
+                            if namap.get(coln) == aggmap.newcol)
+            reduce.append((len(sources), oldcols))
+            sources.append(oldcols[0] if oldcols else 0)
+    trace(2, 'row plan: {} columns, {} aggregated', len(sources), len(reduce))
+    trace(3, 'aggregated columns: {}', reduce)
+    # itemgetter with one index returns the item rather than a tuple.
+    gather = itemgetter(*sources) if len(sources) > 1 else (
+        lambda row: (row[sources[0]],))
+    return RowPlan(gather, tuple(reduce))
+
+
+def new_data_row(row, plan):
+    """
+
+    :param row: the next data row
+    :param plan: created by new_row_plan
+    :return: the newly constructed row with aggregated answers
+    """
+    newrow = list(plan.gather(row))
+    for pos, oldcols in plan.reduce:
+        # Insert the original answer, not the aggregated answer. So, if the
+        # aggregated answer is '55 or over', the value might be '55 - 64' or
+        # '65 or over'. If several are answered, the last one is kept.
+        newans = ''
+        for coln in oldcols:
             if row[coln]:
-                # Insert the original answer, not the aggregated answer. So, if
-                # the aggregated answer is '55 or over', the value might be
-                # '55 - 64' or '65 or over'.
-                nansdict[newans] = row[coln]
-        newrow += nansdict.values()
+                newans = row[coln]
+        newrow[pos] = newans
     return newrow
 
 
+def padded_rows(reader, width):
+    """
+    Pad each short row with empty cells, so that the answers missing from the
+    end of a row are written as unanswered rather than failing the gather.
+
+    :param reader: the csv reader positioned at the first data row
+    :param width: the number of columns in the header
+    :return: an iterator of the data rows, each at least width long
+    """
+    for row in reader:
+        if len(row) < width:
+            row += [''] * (width - len(row))
+        yield row
+
+
+def profile_splice(qdict, profile):
+    """
+    A profile's row is the fully aggregated row made by new_data_row with the
+    columns of each excluded question taken from the data row instead.
+
+    :param qdict: created by get_question_dict
+    :param profile: a Profile
+    :return: a tuple of (from_row, slice) pairs, where from_row is True if the
+             slice is of the data row and False if it is of the aggregated
+             row, or None if the profile excludes nothing
+    """
+    if not profile.exclude:
+        return None
+    splice = [(False, 0, SKIPCOLS)]
+    pos = SKIPCOLS  # in the aggregated row
+    for question, qinf in qdict.items():
+        width = len(AGGDICT[question]) if question in AGGDICT else qinf.len
+        if question in profile.exclude:
+            part = (True, qinf.ix, qinf.ix + qinf.len)
+        else:
+            part = (False, pos, pos + width)
+        pos += width
+        from_row, start, stop = splice[-1]
+        if part[0] == from_row and part[1] == stop:
+            splice[-1] = (from_row, start, part[2])  # contiguous
+        else:
+            splice.append(part)
+    trace(2, 'profile {} splice: {}', profile.outfile, splice)
+    return tuple((from_row, slice(start, stop))
+                 for from_row, start, stop in splice)
+
+
+def splice_row(row, newrow, splice):
+    """
+    :param row: the data row
+    :param newrow: the row made from it by new_data_row
+    :param splice: created by profile_splice
+    :return: the row for the profile
+    """
+    profrow = []
+    for from_row, part in splice:
+        profrow += (row if from_row else newrow)[part]
+    return profrow
+
+
 def check_1_answer(qnum, agmlist, row3):
     """
 
@@ -268,16 +365,17 @@ def check_1_answer(qnum, agmlist, row3):
         trace(1, '    Q{}: unused answer: "{}"', qnum, answer)
 
 
-def check_answers(question_dict, answer_text_row):
+def check_answers(question_dict, answer_text_row, aggdict):
     """
     Display diagnostics for inconsistencies between the configuration and the
     data in the spreadsheet.
 
     :param question_dict: question # -> (column index, length)
     :param answer_text_row: row 3 of the CSV file
+    :param aggdict: AGGDICT or the subset of it to aggregate
     :return:
     """
-    for qn, agmlist in AGGDICT.items():  # agmlist is a list of Aggmap items.
+    for qn, agmlist in aggdict.items():  # agmlist is a list of Aggmap items.
         qinfo = question_dict[qn]
         ix = qinfo.ix
         length = qinfo.len
@@ -285,36 +383,88 @@ def check_answers(question_dict, answer_text_row):
         check_1_answer(qn, agmlist, answer_text_row[ix:ix + length])
 
 
-def main():
+def main(profiles):
+    """
+    Read the input file once and write the output file of each profile.
+
+    :param profiles: the list of Profile namedtuples, the first being for the
+                     outfile argument
+    """
     reader = csv.reader(infile)
-    writer = csv.writer(outfile)
 
     # row 1: has values like q1,,,,q2,,,q3,,etc.
     q_row = next(reader)
     trace(2, 'q_row(len {}): {}', len(q_row), q_row)
     # question_dict: question # -> (column index, length)
     question_dict = get_question_dict(q_row)
-    nq_row = get_question_row(q_row, question_dict)
-    trace(2, 'nq_row(len {}): {}', len(nq_row), nq_row)
-    writer.writerow(nq_row)
-
     # row 2: contains question text in cols under question #'s
     question_text_row = next(reader)
-    nq_row2 = get_question_row(question_text_row, question_dict)
-    trace(2, 'nq_row2(len {}): {}', len(nq_row2), nq_row2)
-    writer.writerow(nq_row2)
-
     # row 3: contains question answers
     answer_text_row = next(reader)
     if args.check:
-        check_answers(question_dict, answer_text_row)
-    na_map, na_row = new_ans_map(answer_text_row, question_dict)
-    writer.writerow(na_row)  # write row 3 with the aggregated answers
+        check_answers(question_dict, answer_text_row,
+                      profile_aggdict(profiles[0]))
+
+    # The columns are gathered once for all the profiles by the plan for
+    # AGGDICT. Each profile only replaces the questions it excludes.
+    na_map, _ = new_ans_map(answer_text_row, question_dict, AGGDICT)
+    plan = new_row_plan(question_dict, na_map, AGGDICT)
+    outputs = []  # (outfile, writer, splice) for each profile
+    for profile in profiles:
+        trace(2, 'profile {}: exclude {}', profile.outfile, profile.exclude)
+        aggdict = profile_aggdict(profile)
+        outfile = codecs.open(profile.outfile, 'w', 'utf-8-sig')
+        writer = csv.writer(outfile)
+        nq_row = get_question_row(q_row, question_dict, aggdict)
+        trace(2, 'nq_row(len {}): {}', len(nq_row), nq_row)
+        writer.writerow(nq_row)
+        nq_row2 = get_question_row(question_text_row, question_dict, aggdict)
+        trace(2, 'nq_row2(len {}): {}', len(nq_row2), nq_row2)
+        writer.writerow(nq_row2)
+        _, na_row = new_ans_map(answer_text_row, question_dict, aggdict)
+        writer.writerow(na_row)  # write row 3 with the aggregated answers
+        outputs.append((outfile, writer,
+                        profile_splice(question_dict, profile)))
 
     # rows 4-n: the survey records
-    for row in reader:
-        newrow = new_data_row(row, question_dict, na_map)
-        writer.writerow(newrow)
+    rows = padded_rows(reader, len(q_row))
+    if len(outputs) == 1 and outputs[0][2] is None:
+        writer = outputs[0][1]
+        writer.writerows(new_data_row(row, plan) for row in rows)
+    else:
+        for row in rows:
+            newrow = new_data_row(row, plan)
+            for _, writer, splice in outputs:
+                writer.writerow(splice_row(row, newrow, splice)
+                                if splice else newrow)
+    for outfile, _, _ in outputs:
+        outfile.close()
+
+
+def parse_exclude(text):
+    """
+    :param text: a question in AGGDICT or several separated by commas
+    :return: the tuple of the questions in lower case
+    """
+    exclude = tuple(q.strip().lower() for q in text.split(',') if q.strip())
+    for q in exclude:
+        if q not in AGGDICT:
+            raise argparse.ArgumentTypeError(
+                f'"{q}" is not a question to be aggregated.')
+    return exclude
+
+
+def parse_profile(text):
+    """
+    :param text: an output file name optionally followed by "=" and the
+                 questions to exclude, like temp/agg2.csv=q16
+    :return: a Profile
+    """
+    outfile, _, exclude = text.partition('=')
+    if not outfile:
+        raise argparse.ArgumentTypeError(
+            f'"{text}" does not start with an output file name.')
+    return Profile(outfile, parse_exclude(exclude))
 
 
 def getargs():
@@ -327,18 +477,33 @@ def getargs():
                         matches the CSV file.
         ''')
     agg_questions = ', '.join(AGGDICT)
-    parser.add_argument('-e', '--exclude', help=f'''
+    parser.add_argument('-e', '--exclude', type=parse_exclude, default=(),
+                        help=f'''
          The named question will not be aggregated. This must be one of:
-         {agg_questions}
+         {agg_questions}. Several may be given separated by commas.
         ''')
     parser.add_argument('infile', help='''
          The CSV file that has been cleaned by extract_csv.sh''')
     parser.add_argument('outfile',
                         help='''output CSV file.
         ''')
+    parser.add_argument('-p', '--profile', type=parse_profile,
+                        action='append', default=[], help='''
+         Also write the file OUTFILE, given as OUTFILE=QUESTIONS, with the
+         questions named in QUESTIONS, separated by commas, not aggregated.
+         For example, "-p temp/agg2.csv=q16". The input file is only read
+         once however many profiles are given. May be repeated.
+        ''')
     parser.add_argument('-v', '--verbose', default=1, type=int, help='''
                         Control verbosity.''')
     _args = parser.parse_args()
+    # A profile writing to another's output file would overwrite it.
+    written = {}
+    for outfile in [_args.outfile] + [p.outfile for p in _args.profile]:
+        path = os.path.realpath(outfile)
+        if path in written:
+            parser.error(f'{outfile} is the same file as {written[path]}.')
+        written[path] = outfile
     return _args
 
 
@@ -346,14 +511,5 @@ if __name__ == '__main__':
     assert sys.version_info >= (3, 11)
     args = getargs()
     infile = codecs.open(args.infile, 'r', 'utf-8-sig')
-    outfile = codecs.open(args.outfile, 'w', 'utf-8-sig')
-    if args.exclude:
-        exclude = args.exclude.lower()
-        if exclude in AGGDICT:
-            del AGGDICT[exclude]
-        else:
-            print(f'"{exclude}" is not a question to be aggregated.')
-            sys.exit(1)
-    INV_AGGDICT = inv_aggdict()
-    main()
+    main([Profile(args.outfile, args.exclude)] + args.profile)
     print('End aggregate.')
@@ -7,6 +7,8 @@
 
 import csv
 from datetime import datetime as dt
+from functools import lru_cache
+import re
 import sys
 from bs4 import BeautifulSoup as Bs
 
@@ -18,6 +20,15 @@ FIXED_HEADER += 'Email Address,First Name,LastName,Custom Data'
 FIXED_HEADER = FIXED_HEADER.replace(' ', '').lower().split(',')
 SKIPCOLS = len(FIXED_HEADER)
 DATE_COLS = ('c', 'd') if config.SHORTSURVEY else ('c', 'd', 'j')
+DATE_COLNS = tuple(col2num(col) for col in DATE_COLS)
+HTML_CACHE_SIZE = 4096  # distinct cells containing markup remembered
+DATE_CACHE_SIZE = 65536  # distinct dates remembered
+BLOCK_ROWS = 10000  # data rows whose dates are converted together
+# The two formats of SurveyMonkey dates, as read by strptime with
+# '%m/%d/%Y %I:%M:%S %p' and, for column 'j', '%d/%m/%Y'.
+DATETIME_PAT = re.compile(r'(\d{1,2})/(\d{1,2})/(\d{4}) (1[0-2]|0?[1-9]):'
+                          r'(\d{2}):(\d{2}) ([AaPp][Mm])')
+DATE_PAT = re.compile(r'(\d{1,2})/(\d{1,2})/(\d{4})')
 
 
 def build_header(row):
@@ -32,13 +43,33 @@ def build_header(row):
     return header
 
 
+@lru_cache(maxsize=HTML_CACHE_SIZE)
+def html_text(cell):
+    """
+    :return: the text of the cell with the HTML tags removed and the entities
+             replaced
+    """
+    return Bs(cell, 'html.parser').get_text()
+
+
+def cell_text(cell):
+    """
+    :return: the same as html_text(cell) but without parsing the cells, nearly
+             all of them, that have no markup
+    """
+    # Without "<" or "&" the parser only changes a cell that is all white
+    # space, which it may replace with a single space.
+    if '<' in cell or '&' in cell or cell.isspace():
+        return html_text(cell)
+    return cell
+
+
 def clean_row(dirtyrow):
     n = 0
     row = []
     for cell in dirtyrow:
         n += 1
-        soup = Bs(cell, 'html.parser')
-        text = soup.get_text()
+        text = cell_text(cell)
         if cell != text:
             print(n, cell, '-->', text)
         # print('{}: {}-->{}'.format(minor, cell, text))
@@ -46,28 +77,72 @@ def clean_row(dirtyrow):
     return row
 
 
-def fix1date(row, col):
-    # print(f'***{col}')
-    # print(row)
-    coln = col2num(col)
-    s = row[coln]
-    if not s:
-        return
-    if ':' in s:
-        # d = dt.strptime(s, '%m/%d/%Y %H:%M:%S')
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def iso_date(s):
+    """
+    :param s: a date in either of the SurveyMonkey formats, like
+              "10/09/2023 06:53:29 PM" or, in column 'j', "09/10/2023"
+    :return: the date in ISO 8601 format, like "2023-10-09T18:53:29Z"
+    :raises ValueError: if the date is in neither format
+    """
+    if m := DATETIME_PAT.fullmatch(s):
+        month, day, year, hour, minute, second, ampm = m.groups()
+        hour = int(hour) % 12 + (12 if ampm.upper() == 'PM' else 0)
+        d = dt(int(year), int(month), int(day), hour, int(minute),
+               int(second))
+    elif m := DATE_PAT.fullmatch(s):
+        # kludge for column 'j' which is in d/m/y order
+        day, month, year = m.groups()
+        d = dt(int(year), int(month), int(day))
+    elif ':' in s:
+        # Any other spelling that strptime accepts.
         d = dt.strptime(s, '%m/%d/%Y %I:%M:%S %p')
     else:
-        # print(f'---------- "{s}"')
-        # kludge for column 'j' which is in d/m/y order
         d = dt.strptime(s, '%d/%m/%Y')
-    row[coln] = d.strftime('%Y-%m-%dT%H:%M:%SZ')
-
-
-def fix_dates(row):
-    # Warning: If changing columns, update fix1date() to get the month and day
-    #          order right.
-    for col in DATE_COLS:
-        fix1date(row, col)
+    return d.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def iso_dates(values):
+    """
+    Convert a column of dates, converting each distinct date once.
+
+    :param values: the dates, some of which may be empty
+    :return: a tuple of the list of the converted dates and the list of the
+             indices of the dates that could not be converted, which are
+             left unchanged
+    """
+    converted = {'': ''}
+    bad = set()
+    for value in set(values) - {''}:
+        try:
+            converted[value] = iso_date(value)
+        except ValueError:
+            converted[value] = value
+            bad.add(value)
+    return ([converted[value] for value in values],
+            [ix for ix, value in enumerate(values) if value in bad]
+            if bad else [])
+
+
+def fix_dates(rows, firstrow):
+    """
+    Convert the dates in DATE_COLS of a block of data rows.
+
+    Warning: If changing columns, update iso_date() to get the month and day
+             order right.
+
+    :param rows: the list of rows, changed in place
+    :param firstrow: the row number in the input file of the first row
+    :return: the list of (row number, column, date) of the dates that could
+             not be converted
+    """
+    bad = []
+    for col, coln in zip(DATE_COLS, DATE_COLNS):
+        dates, badixs = iso_dates([row[coln] for row in rows])
+        for row, date in zip(rows, dates):
+            row[coln] = date
+        bad += [(firstrow + ix, col, rows[ix][coln]) for ix in badixs]
+    return bad
 
 
 def main(infilename, outfilename):
@@ -83,10 +158,22 @@ def main(infilename, outfilename):
     writer.writerow(header)  # new first row
     writer.writerow(row1)
     writer.writerow(row2)
+    bad = []
+    rows = []
+    firstrow = 3  # the row number of the first data row
     for line in reader:
-        row = clean_row(line)
-        fix_dates(row)
-        writer.writerow(row)
+        rows.append(clean_row(line))
+        if len(rows) == BLOCK_ROWS:
+            bad += fix_dates(rows, firstrow)
+            writer.writerows(rows)
+            firstrow += len(rows)
+            rows = []
+    bad += fix_dates(rows, firstrow)
+    writer.writerows(rows)
+    for rownum, col, date in sorted(bad):
+        print(f'Row {rownum}, column {col}: unrecognised date "{date}"')
+    if bad:
+        print(f'{len(bad)} dates were not converted.')
 
 
 if __name__ == '__main__':
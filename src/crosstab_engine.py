@@ -0,0 +1,1305 @@
+"""
+crosstab_engine.py - Count the answers of a survey and lay out the crosstab
+                     sheets of crosstabs5.
+
+A CrosstabEngine is created from the SurveyLayout of a file and the
+CrosstabOptions of a report. It holds no other state and neither changes after
+it is created, so one engine can produce any number of reports from files with
+that layout, and several engines can be used at once in one process, for
+example by a long-lived service, a notebook or the threads of a worker pool.
+The sheets are returned as SheetModels which render_sheet() writes to an
+openpyxl workbook.
+
+crosstabs5.py is the command line wrapper. It adds the cache, the incremental
+state, the worker processes and the daily count cube, which all work by
+calling the engine.
+"""
+from collections import namedtuple, defaultdict
+import hashlib
+from itertools import compress
+
+import numpy as np
+from openpyxl.styles import Font, Alignment, PatternFill
+from openpyxl.styles.borders import Border, Side
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
+from openpyxl.worksheet.worksheet import Worksheet
+
+from config import SKIPCOLS
+from config import CROSSTAB_TITLES as TITLES
+# MAJOR_ and MINOR_ QUESTIONS are lists of strings like ['Q1', 'Q2', ...]
+from config import MAJOR_QUESTIONS, MINOR_QUESTIONS, SANITY_QUESTION
+from intervals import (percentile_interval, resample_weights, wilson,
+                       REPLICATES)
+from segment import segment_rows
+from significance import (stack_tables, table_stats, TableStats,
+                          RESIDUAL_LIMIT, SIGNIFICANCE_LEVEL)
+from survey_cube import Cube, day_crosstab, range_sums, running_total
+from survey_layout import QuestionLayout, SurveyLayout
+from survey_matrix import answered_questions
+#
+# Constants for sheet creation:
+# The row to insert minor titles and answer names
+MINOR_NUMBER_ROW = 3
+MINOR_QUESTION_NAME_ROW = 4
+MINOR_ANSWER_NAME_ROW = 5
+BASE_ROW = 6
+VALID_RESPONSES_ROW = 8
+# The row number where we initialize the loop that inserts row counts.
+MINOR_COUNT_START = 12
+MINOR_COUNT_INCREMENT = 3
+
+LEFT_BORDER = Border(left=Side(border_style='thin'))
+CENTER = Alignment(horizontal='center')
+BOLD = Font(bold=True)
+WRAP = Alignment(wrapText=True)
+CI_FONT = Font(italic=True, size=8)
+CI_COL_WIDTH = 9.0  # wide enough for an interval like "100%-100%"
+HIGH_FILL = PatternFill(fill_type='solid', fgColor='C6EFCE')
+LOW_FILL = PatternFill(fill_type='solid', fgColor='FFC7CE')
+# The statistics rows are below the MEAN VALUE row.
+CHI2_OFFSET = 4
+PVALUE_OFFSET = 5
+CRAMERS_V_OFFSET = 6
+MIN_COL_WIDTH = 6.0
+MAX_COL_WIDTH = 14.0
+
+# Increment if the sheet layout or counting changes, so that the sheets saved
+# in the sheet cache of crosstabs5 --cachedir are not used.
+SHEET_CACHE_VERSION = 5
+# The museum season runs from April to March and is labelled like "2023-24".
+SEASON_START_MONTH = 4
+PERIODS = ('year', 'quarter', 'month', 'season', 'rolling')
+
+# CrosstabOptions: the options of a report, as given on the crosstabs5 command
+# line. Fields not given take the crosstabs5 defaults.
+#   skipcols:   the number of fixed columns before the first question
+#   complete:   if True, only count the rows with an answer to every minor
+#               question
+#   period:     one of PERIODS
+#   year:       if not 0, only count this year
+#   oldestyear: if not 0, only count this year and later
+#   slices:     a list of Slice, one for each workbook, or None
+#   where:      the segment.Segment of the rows to count or None
+#   ci:         None, 'wilson' or 'bootstrap'
+#   verbose:    the level of the progress messages printed by trace()
+#   minors:     the minor questions of each sheet or None for
+#               config.MINOR_QUESTIONS
+CrosstabOptions = namedtuple('CrosstabOptions',
+                             ('skipcols', 'complete', 'period', 'year',
+                              'oldestyear', 'slices', 'where', 'ci',
+                              'verbose', 'minors'),
+                             defaults=(SKIPCOLS, False, 'year', 0, 0, None,
+                                       None, None, 1, None))
+# YearIndex: the rows are counted by time cell, which is the year for
+# --period year and a part of the year for the other periods, so that the
+# periods can be summed from the cells and the cells selected by year.
+#   index:      the index into cells of each row
+#   cells:      the distinct time cells, year * 100 + part of the year
+#   years:      the calendar year of each cell
+#   base:       the number of rows in each cell
+#   selections: for each workbook to be written, a boolean vector of the
+#               cells selected by --year/--oldestyear or by one of the --slices
+#   periods:    the label of each period column, like "2023" or "2023 Q2"
+#   buckets:    an int64 array of shape (periods, cells), 1 where the cell is
+#               part of the period
+YearIndex = namedtuple('YearIndex', ('index', 'cells', 'years', 'base',
+                                     'selections', 'periods', 'buckets'))
+# Slice: one of the --slices. first and last are the first and last years
+# included or 0 if there is no limit.
+Slice = namedtuple('Slice', ('name', 'first', 'last'))
+# CountRows: for the rows to be counted, the "question answered" array from
+# survey_matrix.answered_questions, the index into the YearIndex years of each
+# row's year and the one-hot answer matrix.
+CountRows = namedtuple('CountRows', ('answered', 'years', 'matrix'))
+
+
+class Qdata:
+    """
+    The counts for one major question. The answer labels are not copied; they
+    are the shared tuples in the question's QuestionLayout. All counts are
+    NumPy arrays indexed by answer offset, so the same counts for each minor
+    question are one (major answer x minor answer) array rather than one
+    object per major answer.
+    """
+    __slots__ = ('qnum', 'question', 'startcol', 'limitcol', 'qtext',
+                 'ans_count', 'minor_counts', 'minor_totals', 'value_totals',
+                 'minor_stats', 'intervals',
+                 'years', 'year_answers', 'year_totals', 'year_value_totals',
+                 'year_base', 'total', 'base')
+
+    def __init__(self, qnum: str, question: QuestionLayout):
+        self.qnum = qnum
+        self.question = question
+        self.startcol = self.question.startcol
+        # For example, if our question is q13, limitcol is q14's column number.
+        # An exception to this rule is when a question has been split, in
+        # which case, for example, q9 is replaced by q9.01 ... q9.16. The
+        # SurveyLayout has already found the "next" question's column.
+        self.limitcol = self.question.limitcol
+        # qtext - the text name of the question, from row 2
+        self.qtext = self.question.qtext
+
+        # ans_count - the count of each major answer
+        self.ans_count = None
+
+        # minor_counts - a dict with key minor question # and value an array
+        # of the count of each minor answer (column) for each major answer
+        # (row).
+        self.minor_counts = {}
+
+        # minor_totals - a dict with key minor question # and value the
+        # column totals for each of the answers of the minor question
+        self.minor_totals = {}
+
+        # value_totals - a dict with key minor question # and value the
+        # answer indices. For example, if the first question is given the
+        # value 1 and so on, then value_totals will contain the sum.  This is
+        # used to compute a (highly dubious) mean value for the minor question.
+        self.value_totals = {}
+
+        # minor_stats - a dict with key minor question # and value the
+        # significance.TableStats of the (major answer x minor answer) table
+        self.minor_stats = {}
+
+        # intervals - with --ci, a dict mapping the name of each group of
+        # percentages, as in percent_ratios(), to a tuple of arrays of the
+        # lower and upper bounds of their confidence intervals
+        self.intervals = {}
+
+        # years - the labels of the selected periods, so that even if a
+        # period has no values, that column will still be counted. The year_
+        # arrays are indexed by the offset into this list.
+        self.years = []
+        # year_answers - the count of each major answer (column) in each
+        # period (row)
+        self.year_answers = None
+        self.year_totals = None
+        self.year_value_totals = None
+        self.year_base = None
+        self.total = 0  # valid responses
+        self.base = 0  # all responses
+
+
+class CellModel:
+    """
+    The value and formatting of one cell of a SheetModel. An attribute of
+    None was not set.
+    """
+
+    def __init__(self):
+        self.value = None
+        self.style = None  # a named style like 'Percent'
+        self.font = None
+        self.alignment = None
+        self.border = None
+        self.fill = None
+        self.number_format = None
+
+
+class SheetModel:
+    """
+    The cells and column widths of one worksheet, built by one_sheet() and
+    written to the workbook by render_sheet(). Unlike an openpyxl Worksheet, it
+    can be pickled so sheets can be laid out in worker processes.
+    """
+
+    def __init__(self, title):
+        self.title = title
+        self.cells = {}  # (row, column) -> CellModel
+        self.column_widths = {}  # column letter -> width
+        self.freeze_panes = None
+
+    def cell(self, row, column, value=None):
+        """
+        Like openpyxl's Worksheet.cell(), return the cell at row, column,
+        creating it if necessary, and set its value if one is given.
+        """
+        key = (row, column)
+        if key not in self.cells:
+            self.cells[key] = CellModel()
+        cell = self.cells[key]
+        if value is not None:
+            cell.value = value
+        return cell
+
+
+def trace(verbose, level, template, *args):
+    if verbose >= level:
+        print(template.format(*args))
+
+
+def read_header(survey, skipcols=SKIPCOLS) -> SurveyLayout:
+    """
+    Check the three header rows of the CSV file.
+
+    :param survey: the SurveyMatrix from survey_matrix.load_survey
+    :param skipcols: the number of fixed columns before the first question
+    :return: the SurveyLayout which maps question number to its columns
+    :raises ValueError: if the file is not the output of aggregate->split
+    """
+    question_row = survey.question_row  # has values like q1,,,,q2,,,q3,,etc.
+    if SANITY_QUESTION.lower() not in question_row:
+        raise ValueError('Invalid CSV file. Maybe not the output of '
+                         'aggregate->split.')
+    return SurveyLayout(question_row, survey.question_text_row,
+                        survey.answer_text_row, skipcols)
+
+
+def report_questions(options: CrosstabOptions):
+    """
+    :return: the sorted question numbers whose columns must be loaded for a
+             report, including the questions used by options.where
+    """
+    questions = set(MAJOR_QUESTIONS) | set(options.minors or MINOR_QUESTIONS)
+    if options.where:
+        questions |= set(options.where.questions)
+    return sorted(questions)
+
+
+def parse_dates(dates):
+    """
+    Get the year and month of each date in one pass over the column. The
+    dates have been normalised to ISO format by clean_title.iso_date so the
+    digits are at fixed offsets.
+
+    :param dates: the StartDate column, values like '2017-12-08T19:42:01Z'
+    :return: a tuple of int arrays of the year and month of each row
+    """
+    chars = np.array(dates, dtype='S7').view(np.uint8).reshape(-1, 7)
+    digits = chars.astype(int) - ord('0')
+    valid = (((digits >= 0) & (digits <= 9))[:, [0, 1, 2, 3, 5, 6]].all(axis=1)
+             & (chars[:, 4] == ord('-')))
+    if not valid.all():
+        n = int(np.flatnonzero(~valid)[0])
+        raise ValueError(f'Invalid StartDate "{dates[n]}" in data row {n + 1}')
+    years = digits[:, :4] @ np.array([1000, 100, 10, 1])
+    months = digits[:, 5] * 10 + digits[:, 6]
+    return years, months
+
+
+def time_cells(years, months, period):
+    """
+    :return: the time cell of each row, year * 100 plus the quarter, the
+             half of the year before or after the start of the museum
+             season, the month or, for --period year, zero.
+    """
+    if period == 'year':
+        part = 0
+    elif period == 'quarter':
+        part = (months - 1) // 3 + 1
+    elif period == 'season':
+        part = (months >= SEASON_START_MONTH) + 1
+    else:
+        part = months
+    return years * 100 + part
+
+
+def make_buckets(cells, period):
+    """
+    :param cells: the sorted distinct time cells
+    :param period: one of PERIODS
+    :return: a tuple of the list of period labels and the (periods x cells)
+             bucket array
+    """
+    years, parts = np.divmod(cells, 100)
+    if period == 'season':
+        # The months before the start of the season are in the season that
+        # began the previous year.
+        seasons = years - (parts == 1)
+        starts, index = np.unique(seasons, return_inverse=True)
+        labels = [f'{start}-{(start + 1) % 100:02}'
+                  for start in starts.tolist()]
+        return labels, (index == np.arange(len(starts))[:, None]).astype(
+            np.int64)
+    if period == 'rolling' and len(cells):
+        ordinals = years * 12 + parts - 1
+        # If there is less than a year of data, there is one period.
+        ends = ordinals[ordinals >= ordinals[0] + 11]
+        if not len(ends):
+            ends = ordinals[-1:]
+        labels = [f'12m to {end // 12}-{end % 12 + 1:02}'
+                  for end in ends.tolist()]
+        buckets = ((ordinals > ends[:, None] - 12)
+                   & (ordinals <= ends[:, None])).astype(np.int64)
+        return labels, buckets
+    if period == 'quarter':
+        labels = [f'{year} Q{part}'
+                  for year, part in zip(years.tolist(), parts.tolist())]
+    elif period == 'month':
+        labels = [f'{year}-{part:02}'
+                  for year, part in zip(years.tolist(), parts.tolist())]
+    else:
+        labels = [str(year) for year in years.tolist()]
+    return labels, np.eye(len(cells), dtype=np.int64)
+
+
+def select_years(yearlist, first, last):
+    """
+    :param yearlist: the calendar year of each time cell
+    :return: a boolean vector of the cells in the years from first to last
+             inclusive. If first or last is 0, there is no limit at that end.
+    """
+    selected = np.ones(len(yearlist), dtype=bool)
+    if first:
+        selected &= yearlist >= first
+    if last:
+        selected &= yearlist <= last
+    return selected
+
+
+def period_buckets(yearindex: YearIndex, selected):
+    """
+    A period is only shown if all of its cells are selected. Otherwise a
+    rolling year or a season that overlaps the edge of the selection would be
+    shown with only part of its responses.
+
+    :param yearindex: the YearIndex from CrosstabEngine.make_year_index
+    :param selected: one of the yearindex selections
+    :return: a tuple of the indices of the periods shown, which have
+             responses and all their cells selected, and their buckets over
+             the selected cells
+    """
+    buckets = yearindex.buckets[:, selected]
+    shown = np.flatnonzero((buckets @ yearindex.base[selected] > 0)
+                           & ~yearindex.buckets[:, ~selected].any(axis=1))
+    return shown, buckets[shown]
+
+
+def year_crosstab(xmajor, rowyears, nyears, matrix, columns):
+    """
+    Compute the (time cell x major answer x column) count tensor. The rows are
+    sorted by time cell, as survey_cube.day_crosstab does by day, and each
+    cell's rows are counted by one BLAS matrix product. Only that cell's rows
+    of the columns counted are converted to float64, so the memory needed
+    does not grow with the number of cells or the width of the survey.
+
+    :param xmajor: the major answer columns of the rows to be counted
+    :param rowyears: the index in the YearIndex cells of each row's cell
+    :param nyears: the number of cells in the YearIndex
+    :param matrix: the one-hot answer matrix of the rows
+    :param columns: the columns of the matrix to count. The other columns of
+                    the tensor are zero.
+    :return: an int64 array of shape (cells, major answers, matrix columns)
+    """
+    tensor = np.zeros((nyears, xmajor.shape[1], matrix.shape[1]),
+                      dtype=np.int64)
+    if not len(rowyears):
+        return tensor
+    answers = matrix[:, columns]
+    order = np.argsort(rowyears, kind='stable')
+    cells = rowyears[order]
+    starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+    for start, limit in zip(starts.tolist(),
+                            starts[1:].tolist() + [len(order)]):
+        rows = order[start:limit]
+        counts = (xmajor[rows].T.astype(np.float64)
+                  @ answers[rows].astype(np.float64))
+        tensor[cells[start]][:, columns] = counts
+    return tensor
+
+
+def percent_ratios(total, base, ans_count, year_answers, year_base,
+                   minor_counts):
+    """
+    The count and total of each percentage on a sheet. The arrays may have a
+    leading axis of bootstrap replicates.
+
+    :param total: the count of valid responses
+    :param base: the count of all responses
+    :param ans_count: the count of each major answer
+    :param year_answers: the count of each major answer in each period
+    :param year_base: the count of all responses in each period
+    :param minor_counts: a dict with key minor question # and value the
+                         (major answer x minor answer) counts
+    :return: a dict mapping the name of each group of percentages to a tuple
+             of their counts and totals
+    """
+    total = np.asarray(total)
+    year_totals = year_answers.sum(axis=-1)
+    ratios = {'total': (total, base),
+              'ans_count': (ans_count, total[..., None]),
+              'year_totals': (year_totals, year_base),
+              'year_answers': (year_answers, year_totals[..., None])}
+    for minq, counts in minor_counts.items():
+        minor_totals = counts.sum(axis=-2)
+        ratios[minq, 'totals'] = (minor_totals, total[..., None])
+        ratios[minq, 'counts'] = (counts, minor_totals[..., None, :])
+    return ratios
+
+
+def parse_days(dates):
+    """
+    :param dates: the StartDate column, values like '2017-12-08T19:42:01Z'
+    :return: a datetime64[D] array of the day of each date
+    """
+    parse_dates(dates)  # report a malformed date with its row number
+    return np.array(dates, dtype='U10').astype('datetime64[D]')
+
+
+class CrosstabEngine:
+    """
+    Count the answers of a survey and lay out its sheets. The engine only
+    reads its layout and options, so it can be shared by threads and pickled
+    to worker processes.
+    """
+
+    def __init__(self, layout: SurveyLayout, options=CrosstabOptions()):
+        """
+        :param layout: the SurveyLayout from read_header
+        :param options: the CrosstabOptions of the report
+        """
+        self.layout = layout
+        self.options = options
+
+    def trace(self, level, template, *args):
+        trace(self.options.verbose, level, template, *args)
+
+    def minor_questions(self, major):
+        """
+        :param major: the major question, a string like "Q4"
+        :return: the minor questions of the major question's sheet, which
+                 excludes the major question itself
+        """
+        return [minor for minor in self.options.minors or MINOR_QUESTIONS
+                if minor != major]
+
+    def sheet_columns(self, major):
+        """
+        :param major: the major question, a string like "Q4"
+        :return: an int array of the answer columns of the major question and
+                 its minor questions, the only columns its sheet uses
+        """
+        return np.array([col for qnum in [major] + self.minor_questions(major)
+                         for col in range(self.layout[qnum].startcol,
+                                          self.layout[qnum].limitcol)],
+                        dtype=int)
+
+    def make_major_qdata(self, major):
+        """
+        :param major:  the question for the left column, a string like "q4"
+        :return: this question's empty major QData which will be used to
+        accumulate totals.
+        """
+        qdata = Qdata(major, self.layout[major])
+        self.trace(3, 'qnum {}, startcol: {}, limitcol: {}', major,
+                   qdata.startcol, qdata.limitcol)
+        return qdata
+
+    def validate_rows(self, qdmajor, countrows: CountRows):
+        """
+        A row is valid if it has an answer to the major question and, for each
+        of the minor questions, at least one answer.
+
+        :param qdmajor: The current major question's Qdata
+        :param countrows: the CountRows from make_count_rows
+        :return: a boolean vector, True for each valid row.
+        """
+        offsets = [self.layout.offset(qnum)
+                   for qnum in [qdmajor.qnum]
+                   + self.minor_questions(qdmajor.qnum)]
+        return countrows.answered[:, offsets].all(axis=1)
+
+    def make_year_index(self, dates, weights=None):
+        """
+        :param dates: the StartDate column, values like
+                      '2017-12-08T19:42:01Z'
+        :param weights: the number of rows for each date or None if each date
+                        is one row
+        :return: a YearIndex of the distinct time cells, the index of each
+                 row's cell in that list, the number of rows in each cell, the
+                 selections for each workbook to be written and the periods
+                 summed from the cells.
+        """
+        options = self.options
+        years, months = parse_dates(dates)
+        cells, index = np.unique(time_cells(years, months, options.period),
+                                 return_inverse=True)
+        base = np.bincount(index, weights,
+                           minlength=len(cells)).astype(np.int64)
+        yearlist = cells // 100
+        if options.slices:
+            selections = [select_years(yearlist, yslice.first, yslice.last)
+                          for yslice in options.slices]
+        else:
+            selected = np.ones(len(yearlist), dtype=bool)
+            if options.year:
+                selected &= yearlist == options.year
+            if options.oldestyear:
+                selected &= yearlist >= options.oldestyear
+            selections = [selected]
+        periods, buckets = make_buckets(cells, options.period)
+        return YearIndex(index, cells, yearlist, base, selections, periods,
+                         buckets)
+
+    def make_count_rows(self, survey, yearindex: YearIndex, rows=None):
+        """
+        :param survey: the SurveyMatrix from survey_matrix.load_survey
+        :param yearindex: the YearIndex from make_year_index
+        :param rows: a boolean vector of the rows to count or None for all
+                     rows
+        :return: a CountRows for the rows to be counted
+        """
+        answers = survey.answers
+        years = yearindex.index
+        if rows is not None:
+            answers = answers[rows]
+            years = years[rows]
+        return CountRows(answered_questions(answers, self.layout), years,
+                         answers)
+
+    def major_answers(self, qdmajor: Qdata, countrows: CountRows):
+        """
+        :param qdmajor: The current major question's Qdata
+        :param countrows: the CountRows from make_count_rows
+        :return: the major answer columns of the rows, zero for the rows not
+                 counted
+        """
+        if self.options.complete:
+            counted = self.validate_rows(qdmajor, countrows)
+        else:
+            counted = countrows.answered[:, self.layout.offset(qdmajor.qnum)]
+        self.trace(2, '*****skipping {} of {} rows, no response to {}{}',
+                   len(counted) - int(counted.sum()), len(counted),
+                   qdmajor.qnum,
+                   ' or a minor question' if self.options.complete else '')
+        return (countrows.matrix[:, qdmajor.startcol:qdmajor.limitcol]
+                * counted[:, None])
+
+    def major_tensor(self, qdmajor: Qdata, countrows: CountRows, nyears,
+                     saved=None):
+        """
+        :param qdmajor: The current major question's Qdata
+        :param countrows: the CountRows from make_count_rows
+        :param nyears: the number of time cells in the YearIndex
+        :param saved: the tensor saved by an earlier run with --incremental
+                      or None. The new counts are added to it.
+        :return: the (time cell x major answer x column) count tensor
+        """
+        xmajor = self.major_answers(qdmajor, countrows)
+        tensor = year_crosstab(xmajor, countrows.years, nyears,
+                               countrows.matrix,
+                               self.sheet_columns(qdmajor.qnum))
+        if saved is not None:
+            tensor += saved
+        return tensor
+
+    def count_major(self, qdmajor: Qdata, tensor, yearindex: YearIndex,
+                    selected):
+        """
+        Set the counts of the answers to the major question and, for each
+        major answer, the answers to its minor questions.
+
+        The --year/--oldestyear options or one of the --slices select a slice
+        of the time cells and the sheet totals are the sum over that slice.
+        The period columns are summed from the selected cells using the
+        buckets of the periods that lie wholly within the selection.
+
+        :param qdmajor: The current major question's Qdata
+        :param tensor: the count tensor from major_tensor
+        :param yearindex: the YearIndex from make_year_index
+        :param selected: one of the yearindex selections
+        :return: None
+        """
+        tensor = tensor[selected]
+        cell_base = yearindex.base[selected]
+        shown, buckets = period_buckets(yearindex, selected)
+        qdmajor.years = [yearindex.periods[n] for n in shown]
+        qdmajor.year_base = buckets @ cell_base
+        # The rolling periods overlap so the base is summed over the cells.
+        qdmajor.base = int(cell_base.sum())
+        # The diagonal of the major answer columns is the count of each major
+        # answer.
+        ix = np.arange(qdmajor.limitcol - qdmajor.startcol)
+        cell_answers = tensor[:, ix, qdmajor.startcol + ix]
+        qdmajor.year_answers = buckets @ cell_answers
+        qdmajor.ans_count = cell_answers.sum(axis=0)
+        qdmajor.total = int(qdmajor.ans_count.sum())
+        crosstab = tensor.sum(axis=0)
+        for minor in self.minor_questions(qdmajor.qnum):
+            question = self.layout[minor]
+            qdmajor.minor_counts[minor] = crosstab[:, question.startcol:
+                                                   question.limitcol]
+
+    def bootstrap_intervals(self, qdmajor: Qdata, countrows: CountRows,
+                            yearindex: YearIndex, selected):
+        """
+        Resample the selected rows REPLICATES times and set the percentile
+        interval of each percentage on the sheet. Each batch of replicates is
+        a weight matrix, so the counts for the batch are a few matrix
+        products. The weights are drawn once for all the counted rows and
+        each selection takes the weights of its own rows, so every sheet
+        shares them whatever the number of slices. The counts are at most
+        the number of rows so float32 is exact.
+
+        :param qdmajor: The current major question's Qdata, already counted
+        :param countrows: the CountRows from make_count_rows
+        :param yearindex: the YearIndex from make_year_index
+        :param selected: one of the yearindex selections
+        :return: None
+        """
+        rows = np.flatnonzero(selected[countrows.years])
+        xmajor = self.major_answers(qdmajor, countrows)[rows].astype(
+            np.float32)
+        nrows, nmajor = xmajor.shape
+        # The offset of each row's time cell among the selected cells.
+        rowcells = (np.cumsum(selected) - 1)[countrows.years[rows]]
+        ncells = int(selected.sum())
+        cells = np.zeros((nrows, ncells), dtype=np.float32)
+        cells[np.arange(nrows), rowcells] = 1
+        bycell = (cells[:, :, None] * xmajor[:, None, :]).reshape(nrows, -1)
+        minors = list(qdmajor.minor_counts)
+        columns = [np.arange(self.layout[minor].startcol,
+                             self.layout[minor].limitcol)
+                   for minor in minors]
+        answers = countrows.matrix[np.ix_(rows,
+                                          np.concatenate(columns))].astype(
+            np.float32)
+        # The rows with each major answer, so that the minor counts are one
+        # product per major answer rather than one over every (major answer,
+        # minor answer) pair.
+        majrows = [np.flatnonzero(xmajor[:, ix]) for ix in range(nmajor)]
+        _, buckets = period_buckets(yearindex, selected)
+        cell_base, cell_answers, minor_answers = [], [], []
+        for batch in resample_weights(len(countrows.years)):
+            weights = batch[rows].astype(np.float32)
+            cell_base.append(weights.T @ cells)
+            cell_answers.append(weights.T @ bycell)
+            minor_answers.append(np.stack([weights[ix].T @ answers[ix]
+                                           for ix in majrows], axis=1))
+        cell_base = np.concatenate(cell_base)
+        cell_answers = np.concatenate(cell_answers).reshape(-1, ncells,
+                                                            nmajor)
+        minor_answers = np.concatenate(minor_answers)
+        splits = np.cumsum([len(cols) for cols in columns])[:-1]
+        ans_count = cell_answers.sum(axis=1)
+        ratios = percent_ratios(ans_count.sum(axis=1), cell_base.sum(axis=1),
+                                ans_count,
+                                np.einsum('pc,rcm->rpm', buckets,
+                                          cell_answers),
+                                cell_base @ buckets.T,
+                                dict(zip(minors, np.split(minor_answers,
+                                                          splits, axis=2))))
+        qdmajor.intervals = {key: percentile_interval(*ratio)
+                             for key, ratio in ratios.items()}
+
+    def set_intervals(self, qdmajor: Qdata, countrows: CountRows,
+                      yearindex: YearIndex, selected):
+        """
+        Set the confidence intervals of the percentages for --ci.
+
+        :param qdmajor: The current major question's Qdata, already counted
+        :param countrows: the CountRows from make_count_rows, needed for
+                          --ci bootstrap
+        :param yearindex: the YearIndex from make_year_index
+        :param selected: one of the yearindex selections
+        :return: None
+        """
+        if self.options.ci == 'bootstrap':
+            self.bootstrap_intervals(qdmajor, countrows, yearindex, selected)
+            return
+        ratios = percent_ratios(qdmajor.total, qdmajor.base,
+                                qdmajor.ans_count, qdmajor.year_answers,
+                                qdmajor.year_base, qdmajor.minor_counts)
+        qdmajor.intervals = {key: wilson(*ratio)
+                             for key, ratio in ratios.items()}
+
+    def count_answers(self, major_qdata: Qdata):
+        """
+        Called once for each major question.
+
+        :param major_qdata:
+        :return: None
+        """
+        # The value of each major answer, starting at 1, for the mean value.
+        values = np.arange(1, len(major_qdata.ans_count) + 1)
+        major_qdata.year_totals = major_qdata.year_answers.sum(axis=1)
+        major_qdata.year_value_totals = major_qdata.year_answers @ values
+        for minq, counts in major_qdata.minor_counts.items():
+            self.trace(3, 'minor question: {}, counts: {}', minq,
+                       counts.tolist())
+            # For this major question and this minor question, the sum of
+            # the minor answer counts across all major answers.
+            major_qdata.minor_totals[minq] = counts.sum(axis=0)
+            # valuetotal will be used to compute the mean value
+            major_qdata.value_totals[minq] = values @ counts
+        # Test all the minor questions' tables at once.
+        minors = list(major_qdata.minor_counts)
+        if not minors:
+            return
+        stats = table_stats(stack_tables([major_qdata.minor_counts[minq]
+                                          for minq in minors]))
+        for n, minq in enumerate(minors):
+            ncols = len(major_qdata.minor_totals[minq])
+            major_qdata.minor_stats[minq] = TableStats(
+                float(stats.chi2[n]), int(stats.dof[n]),
+                float(stats.pvalue[n]), float(stats.cramers_v[n]),
+                stats.residuals[n, :, :ncols])
+
+    def select_segment(self, survey):
+        """
+        :param survey: the SurveyMatrix from survey_matrix.load_survey
+        :return: the SurveyMatrix with only the rows in the options.where
+                 segment
+        :raises ValueError: if a question or answer in the segment is not in
+                            the file
+        """
+        where = self.options.where
+        rows, count = segment_rows(where, survey.answers, self.layout)
+        self.trace(1, 'Segment "{}": {} of {} rows.', where.text, count,
+                   len(rows))
+        return survey._replace(
+            respondents=list(compress(survey.respondents, rows)),
+            dates=list(compress(survey.dates, rows)),
+            answers=survey.answers[rows])
+
+    def make_sheets(self, question, countrows: CountRows,
+                    yearindex: YearIndex, saved=None):
+        """
+        Count the answers for one major question and lay out its sheet for
+        each of the workbooks to be written. The counts are computed once and
+        each sheet sums a different selection of the years.
+
+        :param question: the major question, a string like "Q4"
+        :param countrows: the CountRows from make_count_rows
+        :param yearindex: the YearIndex from make_year_index
+        :param saved: the tensor saved by an earlier run with --incremental
+        :return: a tuple of the list of SheetModels for the question, one for
+                 each of the yearindex selections or None if the selection
+                 has no rows, and its count tensor
+        """
+        self.trace(2, "Major question: {}", question)
+        tensor = self.major_tensor(self.make_major_qdata(question), countrows,
+                                   len(yearindex.cells), saved)
+        return (self.lay_out_sheets(question, tensor, yearindex, countrows),
+                tensor)
+
+    def lay_out_sheets(self, question, tensor, yearindex: YearIndex,
+                       countrows: CountRows = None):
+        """
+        :param question: the major question, a string like "Q4"
+        :param tensor: the question's count tensor laid out by yearindex
+                       cells
+        :param yearindex: the YearIndex from make_year_index
+        :param countrows: the rows counted, needed for --ci bootstrap
+        :return: the list of SheetModels for the question, one for each of
+                 the yearindex selections or None if the selection has no
+                 rows
+        """
+        sheets = []
+        for selected in yearindex.selections:
+            if not yearindex.base[selected].any():
+                sheets.append(None)  # this workbook is not written
+                continue
+            major_qdata = self.count_selection(question, tensor, yearindex,
+                                               selected, countrows)
+            sheets.append(self.one_sheet(major_qdata))
+        return sheets
+
+    def count_selection(self, question, tensor, yearindex: YearIndex,
+                        selected, countrows: CountRows = None) -> Qdata:
+        """
+        :param question: the major question, a string like "Q4"
+        :param tensor: the question's count tensor laid out by yearindex
+                       cells
+        :param yearindex: the YearIndex from make_year_index
+        :param selected: one of the yearindex selections, which must have
+                         rows
+        :param countrows: the rows counted, needed for --ci bootstrap
+        :return: the Qdata of the question with the counts, statistics and
+                 confidence intervals of the selection
+        """
+        major_qdata = self.make_major_qdata(question)
+        self.count_major(major_qdata, tensor, yearindex, selected)
+        self.count_answers(major_qdata)
+        if self.options.ci:
+            self.set_intervals(major_qdata, countrows, yearindex, selected)
+        text: str = major_qdata.qtext
+        if len(text) > 50:
+            text = text[:50] + '...'
+        self.trace(1, 'Major question {}: "{}" total {}', major_qdata.qnum,
+                   text, major_qdata.total)
+        return major_qdata
+
+    def report(self, survey):
+        """
+        Count the answers to every major question and lay out their sheets.
+
+        :param survey: the SurveyMatrix from survey_matrix.load_survey with
+                       at least the columns of report_questions()
+        :return: a tuple of the (sheets, tensor) tuple from make_sheets for
+                 each entry in MAJOR_QUESTIONS and the YearIndex
+        """
+        if self.options.where:
+            survey = self.select_segment(survey)
+        yearindex = self.make_year_index(survey.dates)
+        countrows = self.make_count_rows(survey, yearindex)
+        results = [self.make_sheets(question, countrows, yearindex)
+                   for question in MAJOR_QUESTIONS]
+        return results, yearindex
+
+    def sheet_key(self, question, survey, yearindex: YearIndex):
+        """
+        A sheet depends only on the data and header rows of its major and
+        minor questions, the time cells and periods, the titles of the minor
+        questions and the options that change the counts. Hash these so that
+        a change elsewhere in the file or in config.CROSSTAB_TITLES does not
+        invalidate the sheet.
+
+        :return: the name of the sheet's entry in the sheet cache
+        """
+        options = self.options
+        minors = self.minor_questions(question)
+        key = hashlib.sha256()
+        key.update(repr((SHEET_CACHE_VERSION, question, minors,
+                         [TITLES.get(minor) for minor in minors],
+                         options.complete, yearindex.periods,
+                         options.where and options.where.text, options.ci,
+                         REPLICATES)).encode())
+        key.update(yearindex.cells.tobytes())
+        key.update(yearindex.buckets.tobytes())
+        key.update(np.array(yearindex.selections).tobytes())
+        key.update(yearindex.index.tobytes())
+        for qnum in [question] + minors:
+            qlayout = self.layout[qnum]
+            key.update(repr((qlayout.qtext, qlayout.answers)).encode())
+            key.update(np.ascontiguousarray(
+                survey.answers[:, qlayout.startcol:qlayout.limitcol]
+            ).tobytes())
+        return key.hexdigest()
+
+    def state_key(self, survey):
+        """
+        :return: a digest of the header rows and the options that change the
+                 counts. Saved state with a different key cannot be reused.
+        """
+        options = self.options
+        key = hashlib.sha256()
+        for row in (survey.question_row, survey.question_text_row,
+                    survey.answer_text_row):
+            key.update(repr(row).encode())
+        key.update(repr((options.skipcols, options.complete, options.period,
+                         options.where and options.where.text,
+                         options.minors or MINOR_QUESTIONS,
+                         MAJOR_QUESTIONS)).encode())
+        return key.hexdigest()
+
+    def build_cube(self, survey, key) -> Cube:
+        """
+        Count the answers to each major question by day in one pass over the
+        rows.
+
+        :param survey: the SurveyMatrix from survey_matrix.load_survey
+        :param key: the key of the input file, stored in the cube
+        :return: the Cube
+        """
+        days, rowdays = np.unique(parse_days(survey.dates),
+                                  return_inverse=True)
+        countrows = CountRows(answered_questions(survey.answers, self.layout),
+                              rowdays, survey.answers)
+        columns, counts = {}, {}
+        for question in MAJOR_QUESTIONS:
+            qdmajor = self.make_major_qdata(question)
+            columns[question] = self.sheet_columns(question)
+            xmajor = self.major_answers(qdmajor, countrows) > 0
+            counts[question] = running_total(day_crosstab(
+                xmajor, rowdays, len(days),
+                survey.answers[:, columns[question]]))
+        header = {'question_row': survey.question_row,
+                  'question_text_row': survey.question_text_row,
+                  'answer_text_row': survey.answer_text_row}
+        base = running_total(np.bincount(rowdays, minlength=len(days)))
+        return Cube(key, header, days, base, columns, counts)
+
+    def range_sheets(self, cube: Cube, fromdate=None, todate=None):
+        """
+        Lay out the sheets for the days from fromdate to todate using the
+        daily count cube. The count tensor for each time cell in the range is
+        the difference of two running totals.
+
+        :param cube: the Cube from build_cube
+        :param fromdate: the first day reported, like '2023-04-01', or None
+        :param todate: the last day reported or None
+        :return: a tuple of the (sheets, tensor) tuple for each entry in
+                 MAJOR_QUESTIONS and the YearIndex
+        """
+        days = cube.days
+        first = (np.searchsorted(days, np.datetime64(fromdate))
+                 if fromdate else 0)
+        limit = (np.searchsorted(days, np.datetime64(todate), 'right')
+                 if todate else len(days))
+        limit = max(first, limit)
+        self.trace(1, 'Reporting {} days from the cube.', limit - first)
+        yearindex = self.make_year_index(
+            np.datetime_as_string(days[first:limit]),
+            range_sums(cube.base, np.arange(first, limit + 1)))
+        # The days are sorted so each time cell is a contiguous range of days.
+        bounds = first + np.searchsorted(yearindex.index,
+                                         np.arange(len(yearindex.cells) + 1))
+        ncols = len(cube.header['answer_text_row'])
+        results = []
+        for question in MAJOR_QUESTIONS:
+            tensor = np.zeros((len(yearindex.cells),
+                               cube.counts[question].shape[1], ncols),
+                              dtype=np.int64)
+            tensor[:, :, cube.columns[question]] = range_sums(
+                cube.counts[question], bounds)
+            results.append((self.lay_out_sheets(question, tensor, yearindex),
+                            tensor))
+        return results, yearindex
+
+    def one_minor(self, ws, major_qdata, minor_qnum, startcol):
+        """
+        Create the cells in this major question's worksheet for one minor
+        question.
+
+        :param ws: the current worksheet that we're creating
+        :param major_qdata:
+        :param minor_qnum: string in the form 'Q13'
+        :param startcol: column in the worksheet to start inserting this
+                         minor question and its answers
+        :return: the QuestionLayout of the minor question which will be used
+                 by the caller to extract the start and end column values.
+        """
+        question = self.layout[minor_qnum]
+        counts = major_qdata.minor_counts[minor_qnum].tolist()
+        minor_totals = major_qdata.minor_totals[minor_qnum].tolist()
+        value_totals = major_qdata.value_totals[minor_qnum].tolist()
+        stats: TableStats = major_qdata.minor_stats[minor_qnum]
+        # Only shade the cells of a table that is significant as a whole.
+        significant = stats.pvalue < SIGNIFICANCE_LEVEL
+        # put the total values in the "VALID RESPONSES" row.
+        col = startcol - 1
+        row = 0  # avoid warnings
+        # Iterate over the answers for this minor question.
+        for ix, minans in enumerate(question.answers):
+            col += 1
+            cell = ws.cell(row=MINOR_ANSWER_NAME_ROW, column=col,
+                           value=minans)
+            cell.alignment = WRAP
+            width = len(minans) * 1.10
+            width = MIN_COL_WIDTH if width < MIN_COL_WIDTH else width
+            width = MAX_COL_WIDTH if width > MAX_COL_WIDTH else width
+            if self.options.ci:
+                width = max(width, CI_COL_WIDTH)
+            ws.column_widths[get_column_letter(col)] = width
+            row = VALID_RESPONSES_ROW
+            minortotal = minor_totals[ix]
+            setvalue(ws, row, col, minortotal, major_qdata.total,
+                     get_interval(major_qdata, (minor_qnum, 'totals'), ix))
+            # Iterate over the major answers
+            row = MINOR_COUNT_START
+            for majix, majcounts in enumerate(counts):
+                setvalue(ws, row, col, majcounts[ix], minortotal,
+                         get_interval(major_qdata, (minor_qnum, 'counts'),
+                                      majix, ix))
+                residual = stats.residuals[majix, ix]
+                if significant and abs(residual) > RESIDUAL_LIMIT:
+                    ws.cell(row=row, column=col).fill = (
+                        HIGH_FILL if residual > 0 else LOW_FILL)
+                row += MINOR_COUNT_INCREMENT
+            setmean(ws, row, col, value_totals[ix], minortotal)
+        setstat(ws, row + CHI2_OFFSET, startcol, stats.chi2, '#0.00')
+        setstat(ws, row + PVALUE_OFFSET, startcol, stats.pvalue, '0.000')
+        setstat(ws, row + CRAMERS_V_OFFSET, startcol, stats.cramers_v,
+                '0.00')
+        for r in range(3, row + CRAMERS_V_OFFSET + 1):
+            ws.cell(row=r, column=startcol).border = LEFT_BORDER
+        if minor_qnum in TITLES:
+            txt = TITLES[minor_qnum]
+        else:
+            txt = question.qtext
+        cell = ws.cell(row=MINOR_NUMBER_ROW, column=startcol,
+                       value=minor_qnum)
+        cell.font = BOLD
+        cell = ws.cell(row=MINOR_QUESTION_NAME_ROW, column=startcol,
+                       value=txt.upper())
+        cell.font = BOLD
+        return question
+
+    def one_year(self, ws, major_qdata, yix, col):
+        """
+        :param yix: the offset of the period in major_qdata.years
+        """
+        year = major_qdata.years[yix]
+        year_base = int(major_qdata.year_base[yix])
+        width = max(MIN_COL_WIDTH, len(year))
+        if self.options.ci:
+            width = max(width, CI_COL_WIDTH)
+        ws.column_widths[get_column_letter(col)] = width
+        cell = ws.cell(row=MINOR_NUMBER_ROW, column=col, value=str(year))
+        cell.font = BOLD
+        cell.alignment = CENTER
+        setvalue(ws, BASE_ROW, col, year_base, major_qdata.base)
+        row = VALID_RESPONSES_ROW
+        total = int(major_qdata.year_totals[yix])
+        setvalue(ws, row, col, total, year_base,
+                 get_interval(major_qdata, 'year_totals', yix))
+
+        row = MINOR_COUNT_START
+        for ix, value in enumerate(major_qdata.year_answers[yix].tolist()):
+            setvalue(ws, row=row, column=col, value=value, total=total,
+                     interval=get_interval(major_qdata, 'year_answers', yix,
+                                           ix))
+            row += MINOR_COUNT_INCREMENT
+        setmean(ws, row, col, int(major_qdata.year_value_totals[yix]),
+                total)
+
+    def one_sheet(self, major_qdata):
+        """
+        Produce a sheet like:
+    1   |Q13: HOW LIKELY ARE YOU TO RECOMMEND...
+    2   |BASE: ALL RESPONDENTS
+    3   |               |          |Q16: YOUR AGE
+    4   |               |          |Under 55 |55 or over|
+    5   |BASE           |       159|         |          |
+    6   |               |      100%|         |          |
+        |VALID RESPONSES|       136|       39|        97|
+        |               |       86%|      29%|       71%|
+        |               |          |         |          |
+        |Not very       |        19|       18|        11|
+        |               |       14%|      21%|       11%|
+        |               |          |         |          |
+        |Likely         |       117|       31|        86|
+        |               |       86%|      79%|       89%|
+
+        :param major_qdata:
+        :return: the SheetModel to be written by render_sheet()
+        """
+        ws = SheetModel(major_qdata.qnum)
+        title = f'{major_qdata.qnum.upper()}: {major_qdata.qtext.upper()}'
+        a1 = ws.cell(row=1, column=1, value=title)
+        if self.options.where:
+            base = f'BASE: RESPONDENTS WHERE {self.options.where.text}'
+        else:
+            base = 'BASE: ALL RESPONDENTS'
+        a2 = ws.cell(row=2, column=1, value=base)
+        a6 = ws.cell(row=6, column=1, value='BASE')
+        b6 = ws.cell(row=6, column=2, value=major_qdata.base)
+        b7 = ws.cell(row=7, column=2, value=1.0)  # 100%
+        ws.cell(row=8, column=1, value='VALID RESPONSES')
+        b8 = ws.cell(row=8, column=2, value=major_qdata.total)
+        b9 = ws.cell(row=9, column=2,
+                     value=major_qdata.total / major_qdata.base)
+        setinterval(ws, 10, 2, get_interval(major_qdata, 'total'))
+        a1.font = BOLD
+        a2.font = BOLD
+        a6.font = BOLD
+        b6.font = BOLD
+        b8.font = BOLD
+        b7.style = 'Percent'
+        b9.style = 'Percent'
+        # Set the column width of the first column
+        colw = 22
+        for q in major_qdata.question.answers:
+            w = len(q)
+            if w > colw:
+                colw = w
+        ws.column_widths['A'] = colw  # * 1.10
+
+        # Insert the major answers and the response totals.
+        rownum = MINOR_COUNT_START
+        index = 0
+        value_total = 0
+        # iterate over the major answers
+        for majans, ans_total in zip(major_qdata.question.answers,
+                                     major_qdata.ans_count.tolist()):
+            index += 1
+            ws.cell(row=rownum, column=1, value=f'({index}) ' + majans)
+            setvalue(ws, rownum, 2, ans_total, major_qdata.total,
+                     get_interval(major_qdata, 'ans_count', index - 1))
+            value_total += ans_total * index
+            rownum += MINOR_COUNT_INCREMENT
+        ws.cell(row=rownum, column=1, value='MEAN VALUE').font = BOLD
+        try:
+            mean_value = float(value_total) / float(major_qdata.total)
+            cell = ws.cell(row=rownum, column=2, value=mean_value)
+            cell.number_format = '#0.00'
+        except ZeroDivisionError:
+            cell = ws.cell(row=rownum, column=2, value='-')
+            cell.alignment = CENTER
+        cell.font = BOLD
+        comment = ('The mean value must be used with caution. The values are'
+                   ' arbitrarily assiged with the first answer in a column'
+                   ' given a value of 1 and so on.')
+        ws.cell(row=rownum + 2, column=3, value=comment)
+        ws.cell(row=rownum + CHI2_OFFSET, column=1,
+                value='CHI-SQUARE').font = BOLD
+        ws.cell(row=rownum + PVALUE_OFFSET, column=1,
+                value='P VALUE').font = BOLD
+        ws.cell(row=rownum + CRAMERS_V_OFFSET, column=1,
+                value="CRAMÉR'S V").font = BOLD
+        comment = ('Shaded counts differ from the count expected if the'
+                   ' questions were unrelated (adjusted residual beyond'
+                   ' +/-1.96) in a table with a p value below 0.05: green is'
+                   ' higher, red is lower.')
+        ws.cell(row=rownum + CRAMERS_V_OFFSET + 2, column=3, value=comment)
+
+        # Iterate over the minor questions, inserting the minor answers.
+        coln = 3
+        for yix in range(len(major_qdata.years)):
+            self.one_year(ws, major_qdata, yix, coln)
+            coln += 1
+        for minor in major_qdata.minor_totals:
+            question = self.one_minor(ws, major_qdata, minor, coln)
+            minorlen = question.limitcol - question.startcol
+            coln += minorlen
+        ws.freeze_panes = 'C6'
+        return ws
+
+
+def get_interval(major_qdata: Qdata, key, *index):
+    """
+    :param key: the name of a group of percentages as in percent_ratios()
+    :param index: the index of the percentage in the group
+    :return: the (lower, upper) confidence interval of the percentage or
+             None without --ci
+    """
+    if key not in major_qdata.intervals:
+        return None
+    lo, hi = major_qdata.intervals[key]
+    return float(lo[index]), float(hi[index])
+
+
+def setinterval(worksheet, row, column, interval):
+    """
+    Insert a confidence interval like "12%-18%" unless it is None or could
+    not be computed.
+    """
+    if interval is None or np.isnan(interval[0]):
+        return
+    lo, hi = interval
+    cell = worksheet.cell(row=row, column=column, value=f'{lo:.0%}-{hi:.0%}')
+    cell.font = CI_FONT
+    cell.alignment = CENTER
+
+
+def setvalue(worksheet, row, column, value, total, interval=None):
+    """
+    Insert a count and immediately below it insert the percent of the given
+    total and, with --ci, below that its confidence interval.
+    """
+    # print(f"row={row}, col={column}, value={value}, total={total}")
+    cell = worksheet.cell(row=row, column=column, value=value)
+    cell.font = BOLD
+    if total is None:
+        return  # Don't put percent
+    if total:
+        cell = worksheet.cell(row=row + 1, column=column, value=value / total)
+        cell.style = 'Percent'
+    else:  # avoid divide by zero
+        cell = worksheet.cell(row=row + 1, column=column, value='-')
+        cell.alignment = CENTER
+    setinterval(worksheet, row + 2, column, interval)
+
+
+def setmean(worksheet, row, column, value, count):
+    try:
+        meanvalue = float(value) / float(count)
+    except ZeroDivisionError:
+        meanvalue = None
+    if meanvalue is None:
+        cell = worksheet.cell(row=row, column=column, value='-')
+        cell.alignment = CENTER
+    else:
+        cell = worksheet.cell(row=row, column=column, value=meanvalue)
+        cell.number_format = '#0.00'
+    cell.font = BOLD
+
+
+def setstat(worksheet, row, column, value, number_format):
+    """
+    Insert a statistic or '-' if it could not be computed.
+    """
+    if np.isnan(value):
+        cell = worksheet.cell(row=row, column=column, value='-')
+        cell.alignment = CENTER
+    else:
+        cell = worksheet.cell(row=row, column=column, value=value)
+        cell.number_format = number_format
+
+
+def format_cell(cell, cellmodel: CellModel):
+    """
+    Copy the formatting of a CellModel to an openpyxl cell. The fonts,
+    alignments, borders and fills are the shared constants defined above.
+    """
+    # Apply the named style first as it replaces the other attributes.
+    if cellmodel.style is not None:
+        cell.style = cellmodel.style
+    if cellmodel.font is not None:
+        cell.font = cellmodel.font
+    if cellmodel.alignment is not None:
+        cell.alignment = cellmodel.alignment
+    if cellmodel.border is not None:
+        cell.border = cellmodel.border
+    if cellmodel.fill is not None:
+        cell.fill = cellmodel.fill
+    if cellmodel.number_format is not None:
+        cell.number_format = cellmodel.number_format
+
+
+def setup_sheet(ws, model: SheetModel):
+    """
+    Set the column widths, freeze panes and page setup (A4 landscape, fit to
+    page width).
+    """
+    for letter, width in model.column_widths.items():
+        ws.column_dimensions[letter].width = width
+    ws.freeze_panes = model.freeze_panes
+    ws.sheet_properties.pageSetUpPr.fitToPage = True
+    ws.page_setup.fitToHeight = False
+    ws.page_setup.orientation = Worksheet.ORIENTATION_LANDSCAPE
+    ws.page_setup.paperSize = Worksheet.PAPERSIZE_A4
+
+
+def render_sheet(workbook: Workbook, model: SheetModel):
+    """
+    Create a worksheet in the workbook from a SheetModel.
+
+    :param workbook: the Workbook from new_workbook()
+    :param model: the SheetModel returned by CrosstabEngine.one_sheet()
+    :return: None. The workbook is updated.
+    """
+    ws = workbook.create_sheet(model.title)
+    if workbook.write_only:
+        render_write_only(ws, model)
+        return
+    for (row, column), cellmodel in model.cells.items():
+        cell = ws.cell(row=row, column=column, value=cellmodel.value)
+        format_cell(cell, cellmodel)
+    setup_sheet(ws, model)
+
+
+def render_write_only(ws, model: SheetModel):
+    """
+    Append the rows of a SheetModel to a write-only worksheet. The sheet
+    setup must be done before the first row is appended. The rows are
+    streamed to a temporary file so the whole workbook is never held in
+    memory.
+    """
+    setup_sheet(ws, model)
+    rows = defaultdict(dict)  # row number -> {column: CellModel}
+    for (row, column), cellmodel in model.cells.items():
+        rows[row][column] = cellmodel
+    for rownum in range(1, max(rows, default=0) + 1):
+        columns = rows.get(rownum, {})
+        newrow = [None] * max(columns, default=0)
+        for column, cellmodel in columns.items():
+            cell = WriteOnlyCell(ws, value=cellmodel.value)
+            format_cell(cell, cellmodel)
+            newrow[column - 1] = cell
+        ws.append(newrow)
+
+
+def new_workbook(writeonly=False) -> Workbook:
+    """
+    :param writeonly: if True, create an openpyxl write-only workbook
+    :return: an empty Workbook for render_sheet()
+    """
+    if writeonly:
+        return Workbook(write_only=True)  # has no default sheet
+    workbook = Workbook()
+    del workbook[workbook.sheetnames[0]]  # remove the default sheet
+    return workbook
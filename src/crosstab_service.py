@@ -0,0 +1,340 @@
+"""
+crosstab_service.py - A local HTTP service answering crosstab requests.
+
+The cleaned export (the output of aggregate->split as for crosstabs5) is
+loaded once into the one-hot answer matrix and kept in memory with its
+SurveyLayout. Each request is counted by a CrosstabEngine created for it, so
+requests are answered concurrently without parsing the CSV file or importing
+openpyxl again.
+
+    GET /questions
+        A JSON list of the questions in the file with their text and answers.
+
+    GET /crosstab?major=Q13&minors=Q16,Q19&where=...&period=quarter
+        The crosstab of each major question against the minor questions as
+        JSON, or with format=xlsx, as an XLSX workbook laid out like the
+        sheets of crosstabs5. The parameters are:
+
+        major       required, one or more major questions separated by commas
+        minors      the minor questions, default config.MINOR_QUESTIONS
+        where       a segment like "Q16 == '55 or over'", see segment.py
+        period      year (the default), quarter, month, season or rolling
+        year        only count this year
+        oldestyear  only count this year and later
+        complete    if 1, require an answer to every minor question
+        ci          wilson or bootstrap for confidence intervals
+        format      json (the default) or xlsx
+
+The service listens on 127.0.0.1 by default since it has no authentication.
+"""
+import argparse
+import codecs
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import sys
+import traceback
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from config import MINOR_QUESTIONS, SKIPCOLS
+from crosstab_engine import (new_workbook, read_header, render_sheet,
+                             CrosstabEngine, CrosstabOptions, Qdata, PERIODS)
+from segment import parse_segment
+from survey_matrix import load_survey, load_survey_cached
+
+DEFAULT_PORT = 8765
+XLSX_TYPE = ('application/vnd.openxmlformats-officedocument.spreadsheetml'
+             '.sheet')
+FORMATS = ('json', 'xlsx')
+CIS = ('wilson', 'bootstrap')
+
+
+class CrosstabServer(ThreadingHTTPServer):
+    """
+    The HTTP server holding the survey. The survey and layout are only read
+    by the request handlers.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, survey, layout, args):
+        """
+        :param address: the (host, port) to listen on
+        :param survey: the SurveyMatrix from survey_matrix.load_survey
+        :param layout: the SurveyLayout from crosstab_engine.read_header
+        :param args: the command line arguments
+        """
+        super().__init__(address, CrosstabHandler)
+        self.survey = survey
+        self.layout = layout
+        self.skipcols = args.skipcols
+        self.verbose = args.verbose
+
+
+def question_list(text, layout):
+    """
+    :param text: question numbers separated by commas, like "Q16,Q19"
+    :return: the list of question numbers in upper case
+    :raises ValueError: if a question is not in the file
+    """
+    questions = []
+    for qnum in text.split(','):
+        qnum = qnum.strip().upper()
+        if qnum not in layout:
+            raise ValueError(f'{qnum} is not in the file')
+        if qnum not in questions:
+            questions.append(qnum)
+    return questions
+
+
+def parse_query(query, server: CrosstabServer):
+    """
+    :param query: the query string of a /crosstab request
+    :param server: the CrosstabServer
+    :return: a tuple of the list of major questions, the CrosstabOptions and
+             the response format
+    :raises ValueError: if a parameter is missing or invalid
+    """
+    params = {name: values[-1] for name, values in parse_qs(query).items()}
+    if not params.get('major'):
+        raise ValueError('major is required, like major=Q13')
+    majors = question_list(params['major'], server.layout)
+    minors = (question_list(params['minors'], server.layout)
+              if params.get('minors') else None)
+    if minors is None:
+        missing = [qnum for qnum in MINOR_QUESTIONS
+                   if qnum not in server.layout]
+        if missing:
+            raise ValueError(f'the default minors {", ".join(missing)} are '
+                             f'not in the file, give minors=...')
+    period = params.get('period', 'year')
+    if period not in PERIODS:
+        raise ValueError(f'period must be one of {", ".join(PERIODS)}')
+    ci = params.get('ci') or None
+    if ci is not None and ci not in CIS:
+        raise ValueError(f'ci must be one of {", ".join(CIS)}')
+    fmt = params.get('format', 'json')
+    if fmt not in FORMATS:
+        raise ValueError(f'format must be one of {", ".join(FORMATS)}')
+    try:
+        year = int(params.get('year') or 0)
+        oldestyear = int(params.get('oldestyear') or 0)
+    except ValueError:
+        raise ValueError('year and oldestyear must be numbers like 2023')
+    where = parse_segment(params['where']) if params.get('where') else None
+    options = CrosstabOptions(skipcols=server.skipcols,
+                              complete=params.get('complete') == '1',
+                              period=period, year=year, oldestyear=oldestyear,
+                              where=where, ci=ci,
+                              # The engine's progress messages need -v 2.
+                              verbose=server.verbose - 1, minors=minors)
+    return majors, options, fmt
+
+
+def crosstab(server: CrosstabServer, majors, options: CrosstabOptions):
+    """
+    Count the answers to the major questions.
+
+    :return: a tuple of the CrosstabEngine and the list of the counted Qdata
+             of each major question
+    :raises ValueError: if the segment is invalid or no rows are selected
+    """
+    engine = CrosstabEngine(server.layout, options)
+    survey = server.survey
+    if options.where:
+        survey = engine.select_segment(survey)
+    yearindex = engine.make_year_index(survey.dates)
+    selected = yearindex.selections[0]
+    if not yearindex.base[selected].any():
+        raise ValueError('No responses selected.')
+    countrows = engine.make_count_rows(survey, yearindex)
+    qdatas = []
+    for question in majors:
+        tensor = engine.major_tensor(engine.make_major_qdata(question),
+                                     countrows, len(yearindex.cells))
+        qdatas.append(engine.count_selection(question, tensor, yearindex,
+                                             selected, countrows))
+    return engine, qdatas
+
+
+def json_floats(values):
+    """
+    :return: the array as nested lists of floats with None for NaN, which
+             JSON cannot represent
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return np.where(np.isnan(values), None, values).tolist()
+
+
+def json_interval(interval):
+    lo, hi = interval
+    return {'lower': json_floats(lo), 'upper': json_floats(hi)}
+
+
+def qdata_json(qdata: Qdata, layout):
+    """
+    :return: the counts of one major question as a dict for json.dumps
+    """
+    result = {'question': qdata.qnum,
+              'text': qdata.qtext,
+              'answers': list(qdata.question.answers),
+              'base': qdata.base,
+              'total': qdata.total,
+              'counts': qdata.ans_count.tolist(),
+              'periods': qdata.years,
+              'period_base': qdata.year_base.tolist(),
+              'period_counts': qdata.year_answers.tolist(),
+              'minors': {}}
+    intervals = {key: json_interval(interval)
+                 for key, interval in qdata.intervals.items()
+                 if isinstance(key, str)}
+    if intervals:
+        result['intervals'] = intervals
+    for minq, counts in qdata.minor_counts.items():
+        stats = qdata.minor_stats[minq]
+        minor = {'text': layout[minq].qtext,
+                 'answers': list(layout[minq].answers),
+                 'totals': qdata.minor_totals[minq].tolist(),
+                 'counts': counts.tolist(),
+                 'chi2': json_floats(stats.chi2),
+                 'dof': stats.dof,
+                 'pvalue': json_floats(stats.pvalue),
+                 'cramers_v': json_floats(stats.cramers_v),
+                 'residuals': json_floats(stats.residuals)}
+        if (minq, 'totals') in qdata.intervals:
+            minor['intervals'] = {
+                name: json_interval(qdata.intervals[minq, name])
+                for name in ('totals', 'counts')}
+        result['minors'][minq] = minor
+    return result
+
+
+def workbook_bytes(engine: CrosstabEngine, qdatas):
+    """
+    :return: the contents of an XLSX workbook with a sheet for each Qdata
+    """
+    workbook = new_workbook()
+    for qdata in qdatas:
+        render_sheet(workbook, engine.one_sheet(qdata))
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+class CrosstabHandler(BaseHTTPRequestHandler):
+    server: CrosstabServer
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        layout = self.server.layout
+        if url.path == '/questions':
+            self.send_json(HTTPStatus.OK,
+                           [{'question': question.qnum.upper(),
+                             'text': question.qtext,
+                             'answers': list(question.answers)}
+                            for question in layout])
+        elif url.path == '/crosstab':
+            try:
+                majors, options, fmt = parse_query(url.query, self.server)
+                engine, qdatas = crosstab(self.server, majors, options)
+                if fmt == 'xlsx':
+                    body = workbook_bytes(engine, qdatas)
+                else:
+                    result = [qdata_json(qdata, layout) for qdata in qdatas]
+            except ValueError as err:
+                self.send_json(HTTPStatus.BAD_REQUEST, {'error': str(err)})
+                return
+            except Exception as err:
+                # Answer rather than drop the connection, and keep the
+                # traceback for whoever runs the service.
+                traceback.print_exc()
+                self.send_json(HTTPStatus.INTERNAL_SERVER_ERROR,
+                               {'error': f'{type(err).__name__}: {err}'})
+                return
+            if fmt == 'xlsx':
+                self.send_body(HTTPStatus.OK, XLSX_TYPE, body,
+                               f'crosstab_{"_".join(majors)}.xlsx')
+            else:
+                self.send_json(HTTPStatus.OK, result)
+        else:
+            self.send_json(HTTPStatus.NOT_FOUND,
+                           {'error': f'unknown path {url.path}, use '
+                                     f'/questions or /crosstab'})
+
+    def send_json(self, status, value):
+        self.send_body(status, 'application/json',
+                       json.dumps(value, ensure_ascii=False).encode())
+
+    def send_body(self, status, content_type, body, filename=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if filename:
+            self.send_header('Content-Disposition',
+                             f'attachment; filename="{filename}"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose >= 2:
+            super().log_message(format, *args)
+
+
+def main(args):
+    if args.cachedir:
+        survey = load_survey_cached(args.infile, args.cachedir,
+                                    args.skipcols)
+    else:
+        with codecs.open(args.infile, 'r', 'utf-8-sig') as infile:
+            survey = load_survey(infile, args.skipcols)
+    try:
+        layout = read_header(survey, args.skipcols)
+    except ValueError as err:
+        print(err)
+        sys.exit(1)
+    server = CrosstabServer((args.host, args.port), survey, layout, args)
+    if args.verbose >= 1:
+        print(f'Serving {len(survey.dates)} rows of {args.infile} on '
+              f'http://{args.host}:{server.server_port}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def getargs():
+    parser = argparse.ArgumentParser(description='''
+        Serve crosstabs of a CSV file over HTTP, as JSON or XLSX.
+        ''')
+    parser.add_argument('infile', help='''
+         The CSV file that has been processed by the tool chain
+         clean->aggregate->split, as for crosstabs5.''')
+    parser.add_argument('-d', '--cachedir', help='''
+                        If specified, keep the parsed input file in this
+                        directory so that a restart against the unchanged
+                        file does not parse the CSV file.''')
+    parser.add_argument('-H', '--host', default='127.0.0.1', help='''
+                        The address to listen on. The default is 127.0.0.1,
+                        only accepting requests from this computer.''')
+    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT,
+                        help=f'''
+                        The port to listen on. The default is
+                        {DEFAULT_PORT}.''')
+    parser.add_argument('-s', '--skipcols', type=int, default=SKIPCOLS,
+                        help=f'''Number of columns to ignore before extracting
+                        the column numbers for defined questions. Default is
+                        {SKIPCOLS}.''')
+    parser.add_argument('-v', '--verbose', default=1, type=int, help='''
+    Modify verbosity. At 2, each request is logged.
+    ''')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    assert sys.version_info >= (3, 11)
+    main(getargs())
@@ -4,6 +4,31 @@ crosstabs5 - based on crosstabs4 using the Short survey introduced in 2023
 crosstabs - based on crosstabs3 plus additional columns for answers broken
              down by year.
 
+The --period option breaks the answers down by quarter, month, museum season
+or rolling 12 months instead of by calendar year.
+
+Below each minor question's table are the chi-square test of independence of
+the major and minor questions, its p-value and Cramér's V. In a table that is
+significant at the 5% level, the counts whose adjusted residual is beyond
++/-1.96 are shaded green if higher than expected and red if lower, see
+significance.py.
+
+The --ci option adds the 95% confidence interval of each percentage below it,
+computed with the Wilson score interval or by resampling the respondents, see
+intervals.py.
+
+The --where option restricts the report to a segment of the respondents, like
+    --where "Q16 == '55 or over' and Q19 != 'Harrow'"
+see segment.py.
+
+The --from and --to options report on a range of dates using the daily count
+cube stored next to the input file, see survey_cube.py. The cube is built on
+the first run and rebuilt if the input file changes. The input file is only
+hashed to check this if its size or modification time has changed.
+
+The counting and the layout of the sheets are done by a CrosstabEngine, see
+crosstab_engine.py, which can also be used without this command line wrapper.
+
 Input is a CSV file produced by extract_csv.sh. The creation method is:
 1. Click on "Analyze Results".
 2. Click on "SAVE AS".
@@ -28,494 +53,436 @@ The cleaned file is processed before input to crosstabs3:
 """
 import argparse
 import codecs
-from collections import OrderedDict, defaultdict
-import csv
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import ExitStack
+import hashlib
+import os
+import pickle
 import sys
-from openpyxl.styles import Font, Alignment
-from openpyxl.styles.borders import Border, Side
-from openpyxl import Workbook
-from openpyxl.utils import get_column_letter
-from typing import Union
+import numpy as np
 
-from assign_nums import num_dict
 from config import SKIPCOLS
-from config import CROSSTAB_TITLES as TITLES
 # MAJOR_ and MINOR_ QUESTIONS are lists of strings like ['Q1', 'Q2', ...]
-from config import MAJOR_QUESTIONS, MINOR_QUESTIONS, SANITY_QUESTION
-#
-# Constants for sheet creation:
-# The row to insert minor titles and answer names
-MINOR_NUMBER_ROW = 3
-MINOR_QUESTION_NAME_ROW = 4
-MINOR_ANSWER_NAME_ROW = 5
-BASE_ROW = 6
-VALID_RESPONSES_ROW = 8
-# The row number where we initialize the loop that inserts row counts.
-MINOR_COUNT_START = 12
-MINOR_COUNT_INCREMENT = 3
-
-LEFT_BORDER = Border(left=Side(border_style='thin'))
-CENTER = Alignment(horizontal='center')
-BOLD = Font(bold=True)
-WRAP = Alignment(wrapText=True)
-MIN_COL_WIDTH = 6.0
-MAX_COL_WIDTH = 14.0
-
-# TO_COMPARE: A dict for each major question the value is a list of minor
-# questions excluding the current major question.
-TO_COMPARE = {major: [minor for minor in MINOR_QUESTIONS if minor != major]
-              for major in MAJOR_QUESTIONS}
-
-
-class Qdata:
-
-    def __init__(self, qnum: str):
-        self.qnum = qnum
-        self.startcol = q_dict[qnum]
-        trace(3, 'qnum {}, startcol: {}', qnum, self.startcol)
-        # For example, if our question is q13, limitcol is q14's column number.
-        # An exception to this rule is when a question has been split, in
-        # which case, for example, q9 is replaced by q9.01 ... q9.16. So we have
-        # to use a roundabout method to get the "next" question's columm.
-        # Note that there is a dummy entry at the end of q_dict which allows
-        # the last legitimate qnum to compute a limitcol.
-        qlist = list(q_dict)
-        limitix = qlist[qlist.index(qnum) + 1]
-        self.limitcol = q_dict[limitix]
-        trace(3, '  limitix: {}, limitcol: {}', limitix, self.limitcol)
-        # qtext - the text name of the question, from row 2
-        self.qtext = question_text_row[self.startcol]
-
-        # For the major question, the values of the ans_dict are minor question
-        # Qdata instances. Not used for the minor questions. Will be
-        # initialized by make_major_qdata().
-        self.ans_dict: Union[int, dict] = OrderedDict(
-            [(answer_text_row[n], 0)
-             for n in range(self.startcol, self.limitcol)])
-        count_list = [(answer_text_row[n], 0) for n in range(self.startcol,
-                                                             self.limitcol)]
-        by_yr_list = [(t[0], defaultdict(int)) for t in count_list]
-
-        # ans_count - dict mapping the answer text to the count
-        self.ans_count = dict(count_list)
-
-        # year_answers - dict mapping the answer text to a dict keyed by year
-        self.year_answers = dict(by_yr_list)
-
-        # minor_totals - a dict with key minor question # and value the
-        # column totals for each of the answers of the minor question
-        self.minor_totals = None  # will be populated for major question only
-
-        # value_totals - a dict with key minor question # and value the
-        # answer indices. For example, if the first question is given the
-        # value 1 and so on, then value_totals will contain the sum.  This is
-        # used to compute a (highly dubious) mean value for the minor question.
-        self.value_totals = None
-        self.year_totals = None
-        self.year_value_totals = None
-        self.year_base = None
-
-        # Define a set of the valid years so that even if a row has no values
-        # in a year, that column will still be counted.
-        self.yearset = set()
-        self.total = 0  # valid responses
-        self.base = 0  # all responses
-
-
-def trace(level, template, *args):
-    if _args.verbose >= level:
-        print(template.format(*args))
-
-
-def validate_minor(row, qdminor):
-    """
-    Iterate over the possible minor answers and return None if they exist.
-    :param row: the row from the CSV file.
-    :param qdminor: the Qdata for the minor question that corresponds to the
-                    current major question's current answer
-    :return: None if an answer is found, otherwise the question number (Qnn).
-    """
-    error = qdminor.qnum
-
-    for anscol in range(qdminor.startcol, qdminor.limitcol):
-        if row[anscol]:
-            error = None
-            break
-    return error
-
-
-def validate_one_row(row, qdmajor):
-    error = qdmajor.qnum  # error is in major question
-    for anscol in range(qdmajor.startcol, qdmajor.limitcol):
-        if row[anscol]:
-            error = None  # found a major answer
-            anstext = answer_text_row[anscol]  # Male / Female
-            minordict = qdmajor.ans_dict[anstext]
-            # For each of the minor questions, if any have no answers,
-            # the row is invalid.
-            for minorqdata in minordict.values():
-                minorerror = validate_minor(row, minorqdata)
-                if minorerror:
-                    error = minorerror
-                    break
-    return error
-
-
-def count_minor_question(row, qdminor):
-    """
-    Iterate over the possible minor answers and increment the counter when
-    they exist.
-    :param row:
-    :param qdminor: the Qdata for the minor question that corresponds to the
-                    current major question's current answer
-    :return: None
-    """
-    for anscol in range(qdminor.startcol, qdminor.limitcol):
-        if row[anscol]:
-            trace(3, 'count_minor_question: minor: {}, col: {}', qdminor.qnum,
-                  anscol)
-            anstext = answer_text_row[anscol]  # minor answer
-            qdminor.ans_count[anstext] += 1
-
-
-def count_one_row(row, qdmajor: Qdata):
-    """
-    Iterate over the possible major answers. If an answer is present then
-    iterate over its minor questions and increment each minor answer that is
-    present.
-
-    :param row:
-    :param qdmajor: The current major question's Qdata
-    :return: None
-    """
-    # row[2] is like '2017-12-08T19:42:01Z'
-    ansyear = int(row[2][:4])
-    if _args.year and ansyear != _args.year:
-        return
-    if _args.oldestyear and ansyear < _args.oldestyear:
-        return
-    qdmajor.yearset.add(ansyear)
-    qdmajor.base += 1
-    qdmajor.year_base[ansyear] += 1
-    # First check that there is at least one answer to each minor question
-    error = validate_one_row(row, qdmajor) if _args.complete else False
-    if error:
-        trace(2, '*****skipping row {} respondent {}, no response to {}',
-              qdmajor.base, row[0], error)
-        return
+from config import MAJOR_QUESTIONS, MINOR_QUESTIONS
+from crosstab_engine import (new_workbook, read_header, render_sheet,
+                             report_questions, trace, CrosstabEngine,
+                             CrosstabOptions, Slice, YearIndex, PERIODS)
+from segment import parse_segment
+from survey_cube import (cube_path, file_stamp, read_cube, write_cube, Cube,
+                         CUBE_VERSION)
+from survey_matrix import (file_digest, load_survey, load_survey_cached,
+                           SurveyMatrix)
+
+# The sheet cache is a subdirectory of --cachedir.
+SHEET_CACHE_DIR = 'sheets'
+
+
+def make_options(args) -> CrosstabOptions:
+    """
+    :return: the CrosstabOptions given on the command line
+    """
+    return CrosstabOptions(**{field: getattr(args, field)
+                              for field in CrosstabOptions._fields
+                              if hasattr(args, field)})
+
 
-    found = False
-    for anscol in range(qdmajor.startcol, qdmajor.limitcol):
-        trace(3, 'count_one _row: major: {}, col: {}', qdmajor.qnum, anscol)
-        if row[anscol]:
-            found = True
-            anstext = answer_text_row[anscol]  # Male / Female
-            qdmajor.ans_count[anstext] += 1
-            qdmajor.year_answers[anstext][ansyear] += 1
-            qdmajor.total += 1
-            minordict = qdmajor.ans_dict[anstext]
-            for minorqdata in minordict.values():
-                count_minor_question(row, minorqdata)
-    if not found:
-        trace(2, '*****skipping row {} respondent {}, no response to {}',
-              qdmajor.base, row[0], qdmajor.qnum)
-
-
-def make_major_qdata(major, infile):
-    """
-    :param major:  the question for the left column, a string like "q4"
-    :param infile: a pass is made over the data for each major question.
-    :return: this question's populated major QData and the template minor
-    Qdata which contains the minor question and answers and will be used to
-    accumulate totals.
-
-    Also create the global "q_dict" which maps question number to column.
-    """
-    global q_dict, question_text_row, answer_text_row
-    reader = csv.reader(infile)
-    question_row = next(reader)  # has values like q1,,,,q2,,,q3,,etc.
-    if SANITY_QUESTION.lower() not in question_row:
-        print('Invalid CSV file. Maybe not the output of aggregate->split.')
+def make_engine(survey, options: CrosstabOptions) -> CrosstabEngine:
+    """
+    Check the header rows of the file and create the CrosstabEngine for it.
+    """
+    try:
+        layout = read_header(survey, options.skipcols)
+    except ValueError as err:
+        print(err)
         sys.exit(1)
-    # Create a dict mapping Q<minor> -> column index
-    question_row.append('qx')  # dummy column at end for Qdata constructor
-    # map question number (like 'Q4') to column
-    q_dict = num_dict(question_row, _args.skipcols)
-    question_text_row = next(reader)
-    answer_text_row = next(reader)
-    minortuple: list = TO_COMPARE[major]
-    qdmajor = Qdata(major)
-    '''
-        For each major answer, create a dict of minor qdata and store it as the
-        value of the major's answer dictionary.
-    '''
-    for ans in qdmajor.ans_dict:
-        qdmajor.ans_dict[ans] = {minor: Qdata(minor) for minor in minortuple}
-    # Create a dictionary of dictionaries where the outer dictionary is keyed
-    # by the minor questions and the inner dictionaries are each keyed by the
-    # respective minor questions answers.
-    qdmajor.minor_totals = {}
-    qdmajor.value_totals = {}
-    qdmajor.year_totals = defaultdict(int)
-    qdmajor.year_value_totals = defaultdict(int)
-    qdmajor.year_base = defaultdict(int)
-    for minor in minortuple:
-        minorqd = Qdata(minor)
-        qdmajor.minor_totals[minor] = {ans: 0 for ans in minorqd.ans_dict}
-        qdmajor.value_totals[minor] = {ans: 0 for ans in minorqd.ans_dict}
-    for row in reader:
-        count_one_row(row, qdmajor)
-    return qdmajor
-
-
-def count_answers(major_qdata: Qdata):
-    """
-    Called once for each major question.
-
-    :param major_qdata:
-    :return: None
-    """
-    for ix, majans in enumerate(major_qdata.ans_dict, start=1):
-        major_answer_by_year = major_qdata.year_answers[majans]
-        for yr in major_answer_by_year:
-            major_qdata.year_totals[yr] += major_answer_by_year[yr]
-            major_qdata.year_value_totals[yr] += major_answer_by_year[yr] * ix
-        trace(3, 'in count_answers, majans = {}', majans)
-        minor_qdata_dict = major_qdata.ans_dict[majans]
-        for minq in minor_qdata_dict.values():
-            trace(3, 'minor question: {}', minq.qtext)
-            for ans in minq.ans_count:
-                trace(3, r'ans: "{}" ({})', ans, minq.ans_count[ans])
-                minq.total += minq.ans_count[ans]
-            trace(3, 'in count_answers, minq.total = {}', minq.total)
-
-    minq_tuple = TO_COMPARE[major_qdata.qnum]
-    for minq in minq_tuple:
-        # anstotal: For this major question and this minor question, anstotal
-        # is a dictionary where the key is the minor answer and the value is
-        # the sum of the minor answer counts.
-        anstotal = major_qdata.minor_totals[minq]
-        # valuetotal will be used to compute the mean value
-        valuetotal = major_qdata.value_totals[minq]
-        # accumulate minor answers across all major answers
-        for ix, majans in enumerate(major_qdata.ans_dict, start=1):
-            minor_qdata_dict = major_qdata.ans_dict[majans]  # minor Qdata
-            minqdata = minor_qdata_dict[minq]
-            for minans in minqdata.ans_count:  # iterate over minor answers
-                anstotal[minans] += minqdata.ans_count[minans]
-                valuetotal[minans] += minqdata.ans_count[minans] * ix
-
-
-def setvalue(worksheet, row, column, value, total):
-    """
-    Insert a count and immediately below it insert the percent of the given
-    total.
-    """
-    # print(f"row={row}, col={column}, value={value}, total={total}")
-    cell = worksheet.cell(row=row, column=column, value=value)
-    cell.font = Font(bold=True)
-    if total is None:
-        return  # Don't put percent
-    if total:
-        cell = worksheet.cell(row=row + 1, column=column, value=value / total)
-        cell.style = 'Percent'
-    else:  # avoid divide by zero
-        cell = worksheet.cell(row=row + 1, column=column, value='-')
-        cell.alignment = CENTER
-
-
-def setmean(worksheet, row, column, value, count):
+    return CrosstabEngine(layout, options)
+
+
+def sheet_path(cachedir, key):
+    return os.path.join(cachedir, SHEET_CACHE_DIR, key + '.pickle')
+
+
+def load_sheet(cachedir, key):
+    """
+    :return: the (sheets, tensor) tuple saved by save_sheet or None if the
+             sheet is not in the cache or cannot be read.
+    """
     try:
-        meanvalue = float(value) / float(count)
-    except ZeroDivisionError:
-        meanvalue = None
-    if meanvalue is None:
-        cell = worksheet.cell(row=row, column=column, value='-')
-        cell.alignment = CENTER
+        with open(sheet_path(cachedir, key), 'rb') as sheetfile:
+            return pickle.load(sheetfile)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def save_sheet(cachedir, key, result):
+    path = sheet_path(cachedir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as sheetfile:
+        pickle.dump(result, sheetfile)
+    os.replace(path + '.tmp', path)
+
+
+def row_digests(survey):
+    """
+    :return: a digest of each row's answers and start date, used to detect
+             rows that have been edited since the state was saved.
+    """
+    return [hashlib.blake2b(survey.answers[n].tobytes() + date.encode(),
+                            digest_size=16).digest()
+            for n, date in enumerate(survey.dates)]
+
+
+def load_state(engine: CrosstabEngine, statefile, survey, digests,
+               yearindex: YearIndex):
+    """
+    Read the state saved by an earlier run with --incremental. The state
+    is only used if every respondent it contains is still in the file with
+    unchanged answers. Otherwise, all rows are counted.
+
+    :param engine: the CrosstabEngine for the file
+    :param statefile: the name of the --incremental file
+    :param survey: the SurveyMatrix from survey_matrix.load_survey
+    :param digests: the list returned by row_digests
+    :param yearindex: the YearIndex from make_year_index
+    :return: a tuple of a dict mapping major question to its saved count
+             tensor laid out by the cells in yearindex, and a boolean vector
+             of the rows not yet counted.
+    """
+    everything = {}, None
+    if not os.path.exists(statefile):
+        return everything
+    with open(statefile, 'rb') as f:
+        state = pickle.load(f)
+    if state['key'] != engine.state_key(survey):
+        engine.trace(1, 'Questions or options changed, counting all rows.')
+        return everything
+    current = dict(zip(survey.respondents, digests))
+    if len(current) != len(digests):
+        engine.trace(1, 'Duplicate RespondentID, counting all rows.')
+        return everything
+    for respondent, digest in state['rows'].items():
+        if current.get(respondent) != digest:
+            engine.trace(1, 'Respondent {} edited or deleted, counting all '
+                         'rows.', respondent)
+            return everything
+    newrows = np.array([respondent not in state['rows']
+                        for respondent in survey.respondents], dtype=bool)
+    engine.trace(1, 'Counting {} new rows.', int(newrows.sum()))
+    # The new file may have more time cells than the saved state.
+    yearix = np.searchsorted(yearindex.cells, state['cells'])
+    saved = {}
+    for question, savedtensor in state['tensors'].items():
+        tensor = np.zeros((len(yearindex.cells),) + savedtensor.shape[1:],
+                          dtype=np.int64)
+        tensor[yearix] = savedtensor
+        saved[question] = tensor
+    return saved, newrows
+
+
+def save_state(engine: CrosstabEngine, statefile, survey, digests,
+               yearindex: YearIndex, tensors):
+    """
+    Save the count tensors and the digest of each counted row for the next
+    run with --incremental.
+    """
+    state = {'key': engine.state_key(survey),
+             'cells': yearindex.cells.tolist(),
+             'rows': dict(zip(survey.respondents, digests)),
+             'tensors': tensors}
+    tempname = statefile + '.tmp'
+    with open(tempname, 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(tempname, statefile)
+
+
+def cube_key(digest, options: CrosstabOptions):
+    """
+    :param digest: the SHA-256 of the input file
+    :return: a digest of the input file and the options that change the
+             counts. A cube with a different key is rebuilt.
+    """
+    key = hashlib.sha256()
+    key.update(repr((CUBE_VERSION, options.skipcols, options.complete,
+                     MINOR_QUESTIONS, MAJOR_QUESTIONS)).encode())
+    key.update(digest.encode())
+    return key.hexdigest()
+
+
+def load_cube(infile, options: CrosstabOptions) -> Cube:
+    """
+    :return: the Cube stored next to the input file, building it if it does
+             not exist or is out of date.
+    """
+    filename = cube_path(infile)
+    stamp = file_stamp(infile)
+    cube = read_cube(filename)
+    if cube is not None and cube.stamp == stamp:
+        digest = cube.digest
     else:
-        cell = worksheet.cell(row=row, column=column, value=meanvalue)
-        cell.number_format = '#0.00'
-    cell.font = BOLD
-
-
-def one_minor(ws, major_qdata, minor_qnum, startcol):
-    """
-    Create the cells in this major question's worksheet for one minor question.
-
-    :param ws: the current worksheet that we're creating
-    :param major_qdata:
-    :param minor_qnum: string in the form 'Q13'
-    :param startcol: column in the worksheet to start inserting this minor
-                     question and its answers
-    :return: the last used minor Qdata which will be used by the caller to
-             extract the start and end column values.
-             Note that all the Qdata instances for this minor question (one
-             for each major answer) have the same start/end column values.
-    """
-    # put the total values in the "VALID RESPONSES" row.
-    col = startcol - 1
-    minor_qdata = None  # avoid warnings
-    row = 0  # avoid warnings
-    # Iterate over the answers for this minor question.
-    for minans, mincount in major_qdata.minor_totals[minor_qnum].items():
-        col += 1
-        cell = ws.cell(row=MINOR_ANSWER_NAME_ROW, column=col, value=minans)
-        cell.alignment = Alignment(wrapText=True)
-        width = len(minans) * 1.10
-        width = MIN_COL_WIDTH if width < MIN_COL_WIDTH else width
-        width = MAX_COL_WIDTH if width > MAX_COL_WIDTH else width
-        ws.column_dimensions[get_column_letter(col)].width = width
-        row = VALID_RESPONSES_ROW
-        setvalue(ws, row, col, mincount, major_qdata.total)
-        minortotal = major_qdata.minor_totals[minor_qnum][minans]
-        valuetotal = major_qdata.value_totals[minor_qnum][minans]
-        # Iterate over the major answers
-        row = MINOR_COUNT_START
-        for majans, minor_qdata_dict in major_qdata.ans_dict.items():
-            minor_qdata = minor_qdata_dict[minor_qnum]
-            setvalue(ws, row, col, minor_qdata.ans_count[minans], minortotal)
-            row += MINOR_COUNT_INCREMENT
-        setmean(ws, row, col, valuetotal, minortotal)
-    for r in range(3, row + 1):
-        ws.cell(row=r, column=startcol).border = LEFT_BORDER
-    if minor_qnum in TITLES:
-        txt = TITLES[minor_qnum]
+        # The file may have changed, so hash it.
+        digest = file_digest(infile)
+        if cube is not None and cube.digest == digest:
+            cube = cube._replace(stamp=stamp)
+            write_cube(cube, filename)
+    key = cube_key(digest, options)
+    if cube is None or cube.key != key:
+        trace(options.verbose, 1, 'Building {}', filename)
+        with codecs.open(infile, 'r', 'utf-8-sig') as f:
+            survey = load_survey(f, options.skipcols,
+                                 sorted(set(MAJOR_QUESTIONS)
+                                        | set(MINOR_QUESTIONS)))
+        cube = make_engine(survey, options).build_cube(survey, key)._replace(
+            digest=digest, stamp=stamp)
+        write_cube(cube, filename)
+    return cube
+
+
+def range_report(args):
+    """
+    Write the workbooks for the days from --from to --to using the daily
+    count cube.
+    """
+    options = make_options(args)
+    cube = load_cube(args.infile, options)
+    engine = make_engine(SurveyMatrix(**cube.header, respondents=None,
+                                      dates=None, answers=None), options)
+    results, yearindex = engine.range_sheets(cube, args.fromdate,
+                                             args.todate)
+    write_workbooks(args, results, yearindex)
+
+
+def init_worker(engine, survey, yearindex, rows, saved):
+    """
+    Initialize the globals in a worker process for --jobs. This does not rely
+    on the worker being forked from the parent.
+    """
+    global _engine, _countrows, _yearindex, _saved
+    _engine = engine
+    _yearindex = yearindex
+    _countrows = engine.make_count_rows(survey, yearindex, rows)
+    _saved = saved
+
+
+def worker_sheet(question):
+    return _engine.make_sheets(question, _countrows, _yearindex,
+                               _saved.get(question))
+
+
+def outfiles(args):
+    """
+    :return: the names of the workbooks to write. With --slices, the slice
+             name is appended to the output file name, so crosstab.xlsx
+             becomes crosstab_2022.xlsx, crosstab_all.xlsx, etc.
+    """
+    if not args.slices:
+        return [args.outfile]
+    root, ext = os.path.splitext(args.outfile)
+    return [f'{root}_{yslice.name}{ext}' for yslice in args.slices]
+
+
+def open_workbooks(args, yearindex: YearIndex):
+    """
+    :param yearindex: the YearIndex from make_year_index
+    :return: a list of (outfile, workbook) for each name returned by
+             outfiles(). The workbook is None if it has no responses
+             selected and is not to be written.
+    """
+    workbooks = []
+    for n, outfile in enumerate(outfiles(args)):
+        if yearindex.base[yearindex.selections[n]].any():
+            workbooks.append((outfile, new_workbook(args.writeonly)))
+        else:
+            workbooks.append((outfile, None))
+    return workbooks
+
+
+def render_sheets(workbooks, sheets):
+    """
+    Render a major question's sheet into each workbook. With --writeonly
+    the sheet is streamed out, so its SheetModels need not be kept.
+
+    :param workbooks: the list returned by open_workbooks
+    :param sheets: the SheetModel for each workbook
+    """
+    for (_, workbook), model in zip(workbooks, sheets):
+        if workbook is not None:
+            render_sheet(workbook, model)
+
+
+def save_workbooks(args, workbooks):
+    """
+    :param workbooks: the list returned by open_workbooks, with every sheet
+                      rendered
+    """
+    for outfile, workbook in workbooks:
+        if workbook is None:
+            print(f'No responses selected, {outfile} not written.')
+            continue
+        workbook.save(outfile)
+        trace(args.verbose, 1, 'Saved {}', outfile)
+
+
+def write_workbooks(args, results, yearindex: YearIndex):
+    """
+    :param results: the (sheets, tensor) tuple for each entry in
+                    MAJOR_QUESTIONS
+    :param yearindex: the YearIndex from make_year_index
+    """
+    workbooks = open_workbooks(args, yearindex)
+    for sheets, _ in results:
+        render_sheets(workbooks, sheets)
+    save_workbooks(args, workbooks)
+
+
+def computed_sheets(args, engine: CrosstabEngine, survey,
+                    yearindex: YearIndex, rows, saved, keys):
+    """
+    Load the sheets of MAJOR_QUESTIONS from the sheet cache or count and lay
+    them out, in worker processes with --jobs, and save them in the cache.
+    A cache entry that is missing or cannot be read is computed again. Only
+    a few sheets are computed ahead of the one being rendered, so that the
+    finished sheets do not pile up in memory.
+
+    :param rows: the rows to count, as for make_count_rows
+    :param saved: the tensors returned by load_state
+    :param keys: the sheet_key of each major question or None if the sheet
+                 is not cached
+    :return: an iterator of the (sheets, tensor) tuple of each question, in
+             the order of MAJOR_QUESTIONS
+    """
+    ahead = 2 * args.jobs if args.jobs > 1 else 0
+    with ExitStack() as stack:
+        executor = countrows = None
+        # (key to save the sheet under or None, Future of the sheet)
+        pending = deque()
+        for question, key in zip(MAJOR_QUESTIONS, keys):
+            result = None if key is None else load_sheet(args.cachedir, key)
+            if result is not None:
+                engine.trace(2, 'Loaded {} from the cache.', question)
+                future, key = Future(), None
+                future.set_result(result)
+            elif args.jobs > 1:
+                if executor is None:
+                    executor = stack.enter_context(ProcessPoolExecutor(
+                        args.jobs, initializer=init_worker,
+                        initargs=(engine, survey, yearindex, rows, saved)))
+                future = executor.submit(worker_sheet, question)
+            else:
+                if countrows is None:
+                    countrows = engine.make_count_rows(survey, yearindex,
+                                                       rows)
+                future = Future()
+                future.set_result(engine.make_sheets(question, countrows,
+                                                     yearindex,
+                                                     saved.get(question)))
+            pending.append((key, future))
+            while len(pending) > ahead:
+                yield finished_sheet(args, *pending.popleft())
+        while pending:
+            yield finished_sheet(args, *pending.popleft())
+
+
+def finished_sheet(args, key, future):
+    """
+    :param key: the sheet_key to save the sheet under or None
+    :param future: the Future of the (sheets, tensor) tuple
+    :return: the (sheets, tensor) tuple
+    """
+    result = future.result()
+    if key is not None:
+        save_sheet(args.cachedir, key, result)
+    return result
+
+
+def main(args):
+    if args.fromdate or args.todate:
+        range_report(args)
+        return
+    options = make_options(args)
+    # Load the data once into a one-hot answer matrix. The counts for every
+    # major question are computed from it.
+    # Only the columns of the questions in the report are read.
+    questions = report_questions(options)
+    if args.cachedir:
+        survey = load_survey_cached(args.infile, args.cachedir,
+                                    args.skipcols, questions)
     else:
-        txt = minor_qdata.qtext
-    cell = ws.cell(row=MINOR_NUMBER_ROW, column=startcol, value=minor_qnum)
-    cell.font = BOLD
-    cell = ws.cell(row=MINOR_QUESTION_NAME_ROW, column=startcol,
-                   value=txt.upper())
-    cell.font = BOLD
-    return minor_qdata
-
-
-def one_year(ws, major_qdata, year, col):
-    width = MIN_COL_WIDTH
-    ws.column_dimensions[get_column_letter(col)].width = width
-    cell = ws.cell(row=MINOR_NUMBER_ROW, column=col, value=str(year))
-    cell.font = BOLD
-    cell.alignment = CENTER
-    # print(major_qdata.year_base)
-    # print(year, major_qdata.year_base[year])
-    setvalue(ws, BASE_ROW, col, major_qdata.year_base[year], major_qdata.base)
-    row = VALID_RESPONSES_ROW
-    total = major_qdata.year_totals[year]
-    setvalue(ws, row, col, total, major_qdata.year_base[year])
-
-    row = MINOR_COUNT_START
-    for ans in major_qdata.year_answers:
-        value = major_qdata.year_answers[ans][year]
-        setvalue(ws, row=row, column=col, value=value, total=total)
-        row += MINOR_COUNT_INCREMENT
-    setmean(ws, row, col, major_qdata.year_value_totals[year],
-            major_qdata.year_totals[year])
-
-
-def one_sheet(major_qdata):
-    """
-    Produce a sheet like:
-1   |Q13: HOW LIKELY ARE YOU TO RECOMMEND...
-2   |BASE: ALL RESPONDENTS
-3   |               |          |Q16: YOUR AGE
-4   |               |          |Under 55 |55 or over|
-5   |BASE           |       159|         |          |
-6   |               |      100%|         |          |
-    |VALID RESPONSES|       136|       39|        97|
-    |               |       86%|      29%|       71%|
-    |               |          |         |          |
-    |Not very       |        19|       18|        11|
-    |               |       14%|      21%|       11%|
-    |               |          |         |          |
-    |Likely         |       117|       31|        86|
-    |               |       86%|      79%|       89%|
-
-    :param major_qdata:
-    :return: None. The workbook is updated.
-    """
-    major_qdata = major_qdata
-    ws = workbook.create_sheet(major_qdata.qnum)
-    title = f'{major_qdata.qnum.upper()}: {major_qdata.qtext.upper()}'
-    a1 = ws.cell(row=1, column=1, value=title)
-    a2 = ws.cell(row=2, column=1, value='BASE: ALL RESPONDENTS')
-    a6 = ws.cell(row=6, column=1, value='BASE')
-    b6 = ws.cell(row=6, column=2, value=major_qdata.base)
-    b7 = ws.cell(row=7, column=2, value=1.0)  # 100%
-    ws.cell(row=8, column=1, value='VALID RESPONSES')
-    b8 = ws.cell(row=8, column=2, value=major_qdata.total)
-    b9 = ws.cell(row=9, column=2, value=major_qdata.total / major_qdata.base)
-    a1.font = BOLD
-    a2.font = BOLD
-    a6.font = BOLD
-    b6.font = BOLD
-    b8.font = BOLD
-    b7.style = 'Percent'
-    b9.style = 'Percent'
-    # Set the column width of the first column
-    colw = 22
-    for q in major_qdata.ans_dict:
-        w = len(q)
-        if w > colw:
-            colw = w
-    ws.column_dimensions['A'].width = colw  # * 1.10
-
-    # Insert the major answers and the response totals.
-    rownum = MINOR_COUNT_START
-    index = 0
-    value_total = 0
-    for majans in major_qdata.ans_dict:  # iterate over the major answers
-        index += 1
-        ws.cell(row=rownum, column=1, value=f'({index}) ' + majans)
-        ans_total = major_qdata.ans_count[majans]
-        setvalue(ws, rownum, 2, ans_total, major_qdata.total)
-        value_total += ans_total * index
-        rownum += MINOR_COUNT_INCREMENT
-    ws.cell(row=rownum, column=1, value='MEAN VALUE').font = BOLD
+        with codecs.open(args.infile, 'r', 'utf-8-sig') as infile:
+            survey = load_survey(infile, args.skipcols, questions)
+    engine = make_engine(survey, options)
+    if args.where:
+        try:
+            survey = engine.select_segment(survey)
+        except ValueError as err:
+            print(f'Invalid --where: {err}')
+            sys.exit(1)
+    yearindex = engine.make_year_index(survey.dates)
+    saved, rows = {}, None
+    if args.incremental:
+        digests = row_digests(survey)
+        saved, rows = load_state(engine, args.incremental, survey, digests,
+                                 yearindex)
+    keys = [None] * len(MAJOR_QUESTIONS)
+    if args.cachedir:
+        keys = [engine.sheet_key(question, survey, yearindex)
+                for question in MAJOR_QUESTIONS]
+    computed = computed_sheets(args, engine, survey, yearindex, rows, saved,
+                               keys)
+    # Render each sheet as soon as it is available and, with --incremental,
+    # keep only its tensor for the state file.
+    workbooks = open_workbooks(args, yearindex)
+    tensors = {}
+    for question, (sheets, tensor) in zip(MAJOR_QUESTIONS, computed):
+        render_sheets(workbooks, sheets)
+        if args.incremental:
+            tensors[question] = tensor
+        del sheets, tensor  # before the next sheet is computed
+    save_workbooks(args, workbooks)
+    if args.incremental:
+        save_state(engine, args.incremental, survey, digests, yearindex,
+                   tensors)
+
+
+def parse_slices(text):
+    """
+    Convert the argument of --slices to a list of Slice namedtuples.
+    """
+    slices = []
+    for name in text.split(','):
+        name = name.strip()
+        try:
+            if name == 'all':
+                slices.append(Slice(name, 0, 0))
+            elif '-' in name:
+                first, last = name.split('-', 1)
+                slices.append(Slice(name, int(first or 0), int(last or 0)))
+            else:
+                slices.append(Slice(name, int(name), int(name)))
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'invalid slice "{name}"')
+    return slices
+
+
+def parse_day(text):
+    """
+    Convert the argument of --from or --to to an ISO date string.
+    """
     try:
-        mean_value = float(value_total) / float(major_qdata.total)
-        cell = ws.cell(row=rownum, column=2, value=mean_value)
-        cell.number_format = '#0.00'
-    except ZeroDivisionError:
-        cell = ws.cell(row=rownum, column=2, value='-')
-        cell.alignment = CENTER
-    cell.font = BOLD
-    comment = ('The mean value must be used with caution. The values are'
-               ' arbitrarily assiged with the first answer in a column given a'
-               ' value of 1 and so on.')
-    ws.cell(row=rownum + 2, column=3, value=comment)
-
-    # Iterate over the minor questions, inserting the minor answers.
-    coln = 3
-    for year in sorted(major_qdata.yearset):
-        one_year(ws, major_qdata, year, coln)
-        coln += 1
-    for minor in major_qdata.minor_totals:
-        minor_qdata = one_minor(ws, major_qdata, minor, coln)
-        minorlen = minor_qdata.limitcol - minor_qdata.startcol
-        coln += minorlen
-    ws.freeze_panes = 'C6'
-    ws.sheet_properties.pageSetUpPr.fitToPage = True
-    ws.page_setup.fitToHeight = False
-    ws.page_setup.orientation = ws.ORIENTATION_LANDSCAPE
-    ws.page_setup.paperSize = ws.PAPERSIZE_A4
-
-
-def main():
-    global workbook
-    workbook = Workbook()
-    del workbook[workbook.sheetnames[0]]  # remove the default sheet
-    for question in MAJOR_QUESTIONS:
-        with codecs.open(_args.infile, 'r', 'utf-8-sig') as infile:
-            trace(2, "Major question: {}", question)
-            major_qdata = make_major_qdata(question, infile)
-            count_answers(major_qdata)
-            one_sheet(major_qdata)
-            text: str = major_qdata.qtext
-            if len(text) > 50:
-                text = text[:50] + '...'
-            trace(1, 'Major question {}: "{}" total {}', major_qdata.qnum,
-                  text, major_qdata.total)
-    workbook.save(_args.outfile)
+        return str(np.datetime64(text, 'D'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid date "{text}", use '
+                                         f'YYYY-MM-DD')
+
+
+def parse_where(text):
+    """
+    Convert the argument of --where to a segment.Segment.
+    """
+    try:
+        return parse_segment(text)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err))
 
 
 def getargs():
@@ -532,22 +499,88 @@ def getargs():
     parser.add_argument('-c', '--complete', action='store_true', help='''
                         If specified, require that each minor question has
                         at least one answer otherwise the row is rejected.''')
+    parser.add_argument('-C', '--ci', choices=('wilson', 'bootstrap'),
+                        help='''
+                        If specified, insert the 95% confidence interval of
+                        each percentage below it, computed with the Wilson
+                        score interval or from 1000 bootstrap resamples of
+                        the respondents.''')
+    parser.add_argument('-d', '--cachedir', help='''
+                        If specified, keep the parsed input file and each
+                        sheet in this directory. Later runs against the
+                        unchanged file load it from the cache instead of
+                        parsing the CSV file, and only the sheets whose
+                        questions, titles or options have changed are
+                        recomputed.''')
+    parser.add_argument('-f', '--from', dest='fromdate', type=parse_day,
+                        help='''
+                        If specified, only report responses on or after
+                        this date, like 2023-04-01. The counts are taken from
+                        the daily count cube stored next to the input file,
+                        which is built if it does not exist.''')
+    parser.add_argument('-i', '--incremental', metavar='STATEFILE', help='''
+                        If specified, save the counts and the RespondentIDs
+                        counted in this file. The next run only counts the
+                        rows that have been added since. If any saved row has
+                        been edited or deleted, all rows are counted.''')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='''
+                        The number of worker processes used to count and lay
+                        out the sheets. The default is 1, meaning no worker
+                        processes.''')
     parser.add_argument('-o', '--oldestyear', type=int, default=0,
                         help='''
                         If specified, ignore responses before this year.
                         ''')
+    parser.add_argument('-p', '--period', choices=PERIODS, default='year',
+                        help='''
+                        The period for the columns that break down the major
+                        answers by date. "season" is the museum season from
+                        April to March and "rolling" is the 12 months ending
+                        with each month. The default is "year".''')
     parser.add_argument('-s', '--skipcols', type=int, default=SKIPCOLS,
                         help=f'''Number of columns to ignore before extracting
                         the column numbers for defined questions. Default is
                         {SKIPCOLS}.''')
+    parser.add_argument('-S', '--slices', type=parse_slices, help='''
+                        A comma separated list of year slices. One workbook
+                        is written for each slice from a single load and
+                        count. A slice is "all", a year like "2023", or a
+                        range like "2022-2024", "2022-" or "-2023". The
+                        slice name is appended to the output file name.''')
+    parser.add_argument('-t', '--to', dest='todate', type=parse_day,
+                        help='''
+                        If specified, only report responses on or before
+                        this date. Like --from, the daily count cube is
+                        used.''')
     parser.add_argument('-v', '--verbose', default=1, type=int, help='''
     Modify verbosity.
     ''')
+    parser.add_argument('-W', '--where', type=parse_where, help='''
+                        If specified, only report the respondents in a
+                        segment, like "Q16 == '55 or over' and Q19 !=
+                        'Harrow'". Use ==, !=, in and not in to compare a
+                        question with its answers and combine the
+                        comparisons with and, or, not and parentheses.''')
+    parser.add_argument('-w', '--writeonly', action='store_true', help='''
+                        If specified, stream the sheets to the output file
+                        using an openpyxl write-only workbook. This uses less
+                        memory for large workbooks.''')
     parser.add_argument('-y', '--year', type=int, default=0,
                         help='''
                         If specified, only process responses from this year.
                         ''')
     args = parser.parse_args()
+    if args.slices and (args.year or args.oldestyear):
+        parser.error('--slices cannot be used with --year or --oldestyear')
+    if args.ci == 'bootstrap' and (args.incremental or args.fromdate
+                                   or args.todate):
+        parser.error('--ci bootstrap needs every response so it cannot be '
+                     'used with --incremental, --from or --to')
+    if ((args.fromdate or args.todate)
+            and (args.cachedir or args.incremental or args.jobs > 1
+                 or args.where)):
+        parser.error('--from and --to cannot be used with --cachedir, '
+                     '--incremental, --jobs or --where')
     return args
 
 
@@ -555,9 +588,5 @@ if __name__ == '__main__':
     assert sys.version_info >= (3, 11)
     if len(sys.argv) == 1:
         sys.argv.append('-h')
-    _args = getargs()
-    # avoid global variable warning
-    workbook: Workbook | None = None
-    q_dict, question_text_row, answer_text_row = {}, [], []
-    main()
+    main(getargs())
     print('End crosstabs5.')
@@ -0,0 +1,82 @@
+"""
+intervals.py - 95% confidence intervals for the percentages in a crosstab.
+
+wilson() computes the Wilson score interval of each percentage from its
+count and total. The bootstrap resamples the respondents: each replicate is
+a row of a weight matrix giving the number of times each respondent was
+drawn, so that the counts for a batch of replicates are one matrix product
+with the respondents' answers rather than a pass over the rows for each
+replicate.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+Z95 = 1.959963984540054  # the 97.5th percentile of the normal distribution
+REPLICATES = 1000
+BATCH = 100  # replicates per weight matrix
+SEED = 20231  # fixed so that reruns give the same intervals
+
+
+def wilson(count, total, z=Z95):
+    """
+    :param count: an array of counts
+    :param total: the totals, broadcast with count
+    :return: a tuple of arrays of the lower and upper bounds, NaN where the
+             total is zero
+    """
+    count = np.asarray(count, dtype=np.float64)
+    total = np.asarray(total, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = count / total
+        denominator = 1 + z * z / total
+        centre = (p + z * z / (2 * total)) / denominator
+        margin = (z * np.sqrt(p * (1 - p) / total
+                              + z * z / (4 * total * total))
+                  / denominator)
+    return centre - margin, centre + margin
+
+
+@lru_cache(maxsize=1)
+def resample_weights(nrows, seed=SEED):
+    """
+    Draw nrows respondent indices with replacement for each of REPLICATES
+    replicates. The weights depend only on the number of rows so they are
+    computed once for all the counted rows and shared by all the sheets,
+    each taking the rows it counts.
+
+    :return: a tuple of uint8 arrays of shape (nrows, replicates in batch),
+             the number of times each row was drawn in each replicate. A
+             row cannot be drawn more than 255 times unless nrows is large
+             enough that it never happens in practice.
+    """
+    rng = np.random.default_rng(seed)
+    batches = []
+    for start in range(0, REPLICATES, BATCH):
+        nreps = min(BATCH, REPLICATES - start)
+        draws = rng.integers(0, nrows, size=(nreps, nrows))
+        draws += np.arange(nreps)[:, None] * nrows
+        # Rows first, so the weights of a subset of the rows are contiguous.
+        batches.append(np.bincount(draws.ravel(), minlength=nreps * nrows)
+                       .reshape(nreps, nrows).T.astype(np.uint8, order='C'))
+    return tuple(batches)
+
+
+def percentile_interval(count, total):
+    """
+    :param count: the counts of each replicate, replicates on the first axis
+    :param total: the totals of each replicate, broadcast with count
+    :return: a tuple of arrays of the 2.5th and 97.5th percentiles of the
+             replicate percentages, NaN if no replicate has a total
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(total > 0, count / total, np.nan)
+    # nanpercentile warns about cells with no total in any replicate so only
+    # pass it the others.
+    valid = ~np.isnan(ratio).all(axis=0)
+    lo = np.full(ratio.shape[1:], np.nan)
+    hi = np.full(ratio.shape[1:], np.nan)
+    if valid.any():
+        lo[valid], hi[valid] = np.nanpercentile(ratio[:, valid], [2.5, 97.5],
+                                                axis=0)
+    return lo, hi
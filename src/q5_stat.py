@@ -13,7 +13,11 @@ Question 5 is broken down by age group:
 For each age group, there are five values:
 1, 2, 3, 4 or over, not sure
 
-
+Only whether each cell is empty matters, so with --cachedir the file is read
+through survey_matrix.load_survey_cached() and a rerun against an unchanged
+file does not parse the CSV file again. As q3 is tested after stripping white
+space, the question holding the q3 column is read again with strip=True and
+cached as a separate entry.
 
 """
 import argparse
@@ -22,7 +26,12 @@ import csv
 import datetime
 import os.path
 import sys
-from config import SKIPROWS
+
+import numpy as np
+
+from config import SKIPCOLS, SKIPROWS
+from survey_layout import SurveyLayout
+from survey_matrix import load_survey_cached
 
 
 def getgroupsize(row, q5col):
@@ -38,6 +47,43 @@ def getgroupsize(row, q5col):
     return groupsize
 
 
+def matrix_counts(filename, cachedir):
+    """
+    Count the group sizes as main() does, from the one-hot answer matrices.
+
+    :param filename: the CSV file
+    :param cachedir: the directory holding the cache entries
+    :return: a tuple of the dict of group size -> number of parties, the
+             number not sure and the number of q3/q5 conflicts
+    """
+    survey = load_survey_cached(filename, cachedir, SKIPCOLS)
+    layout = SurveyLayout(survey.question_row, skipcols=SKIPCOLS)
+    for qnum in ('q3', 'q5'):
+        if qnum not in layout:
+            raise ValueError('Cannot find "{}" in header.'.format(qnum))
+    q3col = layout['q3'].startcol
+    q5col = layout['q5'].startcol
+    # The question holding the column after q3's first column
+    q3next = [question.qnum for question in layout
+              if question.startcol <= q3col + 1 < question.limitcol]
+    q3answered = load_survey_cached(filename, cachedir, SKIPCOLS, q3next,
+                                    strip=True).answers[:, q3col + 1]
+    # (rows, age group, value) where the values are 1, 2, 3, 4 or over and
+    # not sure
+    q5 = np.asarray(survey.answers[:, q5col:q5col + 25],
+                    dtype=bool).reshape(-1, 5, 5)
+    sure = ~q5[:, :, 4].any(axis=1)
+    # The first value ticked in each age group adds its index + 1.
+    ticked = q5[:, :, :4]
+    groupsize = 1 + ((ticked.argmax(axis=2) + 1)
+                     * ticked.any(axis=2)).sum(axis=1)
+    conflict = sure & (groupsize == 1) & (q3answered == 0)
+    sizes, counts = np.unique(groupsize[sure & ~conflict],
+                              return_counts=True)
+    parties = dict(zip(sizes.tolist(), counts.tolist()))
+    return parties, int((~sure).sum()), int(conflict.sum())
+
+
 def print_report(parties, notsure, q3q5conflict):
     def prints(*data):
         print(*data)
@@ -70,6 +116,9 @@ def main():
     q3q5conflict = 0
     if SKIPROWS <= 0:
         raise ValueError('The heading must exist to find Q5 column.')
+    if _args.cachedir:
+        print_report(*matrix_counts(_args.infile, _args.cachedir))
+        return
     with open(_args.infile, newline='', encoding='utf-8-sig') as csvfile:
         monkeyreader = csv.reader(csvfile)
         row = next(monkeyreader)
@@ -104,6 +153,10 @@ def getargs():
     parser.add_argument('infile', help='''
     The CSV file that has been cleaned by remove_nuls.py, merge_csv.py, and
     clean_title.py''')
+    parser.add_argument('-d', '--cachedir', help='''
+        If specified, keep the parsed input file in this directory so that a
+        rerun against the unchanged file does not parse the CSV file.
+        ''')
     parser.add_argument('-o', '--outdir', default='results', help='''
         Directory to contain the
         output report file. If omitted, the default is the directory
@@ -0,0 +1,219 @@
+"""
+segment.py - Select the respondents in a segment described by an expression
+             like:
+
+    Q16 == '55 or over' and Q19 != 'Harrow'
+
+The expression is parsed with the Python ast module but never evaluated as
+Python. The allowed forms are:
+
+    Qn == 'answer'          the respondent chose the answer. Qn is a question
+                            number like Q16 or Q9.01.
+    Qn != 'answer'          the respondent answered Qn but not with the answer
+    Qn in ('a1', 'a2')      the respondent chose any of the answers
+    Qn not in ('a1', 'a2')  the respondent answered Qn but with none of them
+    and, or, not and parentheses
+
+Each answer column used is converted to a bitmap with one bit per row, packed
+eight rows to a byte, and the expression is evaluated with bitwise AND, OR and
+NOT over the bitmaps rather than row by row.
+"""
+import ast
+from collections import namedtuple
+import io
+import re
+import tokenize
+
+import numpy as np
+
+from survey_layout import SurveyLayout
+
+# A question number like Q9.01 is not a Python name so it is parsed as Q9_01.
+SUBQUESTION = re.compile(r'\b([Qq]\d+)\.(\d+)\b')
+# The number of bits set in each byte value, for NumPy before 2.0 which has
+# no bitwise_count.
+BITCOUNTS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None],
+                          axis=1).sum(axis=1)
+
+# text:      the expression as given
+# tree:      the ast expression
+# questions: the question numbers used, in upper case
+Segment = namedtuple('Segment', ('text', 'tree', 'questions'))
+
+
+def _question(node):
+    if not isinstance(node, ast.Name):
+        raise ValueError(f'expected a question number like Q16, found '
+                         f'"{ast.unparse(node)}"')
+    return node.id.upper().replace('_', '.')
+
+
+def _labels(node):
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return [node.value]
+    if (isinstance(node, (ast.Tuple, ast.List)) and node.elts
+            and all(isinstance(elt, ast.Constant)
+                    and isinstance(elt.value, str) for elt in node.elts)):
+        return [elt.value for elt in node.elts]
+    raise ValueError(f'expected an answer in quotes, found '
+                     f'"{ast.unparse(node)}"')
+
+
+def _check(node, questions):
+    """
+    Check that the node uses only the allowed forms and add the question
+    numbers it uses to questions.
+    """
+    if isinstance(node, ast.BoolOp):
+        for value in node.values:
+            _check(value, questions)
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        _check(node.operand, questions)
+    elif isinstance(node, ast.Compare):
+        if len(node.ops) != 1:
+            raise ValueError(f'chained comparison "{ast.unparse(node)}"')
+        op = node.ops[0]
+        if isinstance(op, (ast.Eq, ast.NotEq)):
+            if not isinstance(node.comparators[0], ast.Constant):
+                raise ValueError(f'use "in" to compare with a list of '
+                                 f'answers: "{ast.unparse(node)}"')
+        elif not isinstance(op, (ast.In, ast.NotIn)):
+            raise ValueError(f'unsupported comparison "{ast.unparse(node)}"')
+        questions.append(_question(node.left))
+        _labels(node.comparators[0])
+    else:
+        raise ValueError(f'unsupported expression "{ast.unparse(node)}"')
+
+
+def _python_names(text):
+    """
+    :return: the text with each question number like Q9.01 replaced by a
+             Python name like Q9_01. The quoted answers are not changed.
+    :raises tokenize.TokenError: if a quote or parenthesis is not closed
+    """
+    offsets = [0, 0]  # the offset of the start of each line, from line 1
+    for line in text.splitlines(keepends=True):
+        offsets.append(offsets[-1] + len(line))
+    parts = []
+    pos = 0
+    for token in tokenize.generate_tokens(io.StringIO(text).readline):
+        if token.type == tokenize.STRING:
+            start = offsets[token.start[0]] + token.start[1]
+            end = offsets[token.end[0]] + token.end[1]
+            parts += [SUBQUESTION.sub(r'\1_\2', text[pos:start]),
+                      text[start:end]]
+            pos = end
+    parts.append(SUBQUESTION.sub(r'\1_\2', text[pos:]))
+    return ''.join(parts)
+
+
+def parse_segment(text) -> Segment:
+    """
+    :param text: the segment expression
+    :return: a Segment
+    :raises ValueError: if the expression is not valid
+    """
+    try:
+        tree = ast.parse(_python_names(text.strip()), mode='eval').body
+    except SyntaxError as err:
+        raise ValueError(f'syntax error in "{text}": {err.msg}')
+    except tokenize.TokenError as err:
+        raise ValueError(f'syntax error in "{text}": {err.args[0]}')
+    questions = []
+    _check(tree, questions)
+    return Segment(text, tree, sorted(set(questions)))
+
+
+class Bitmaps:
+    """
+    The packed bitmaps of the answer columns, created as they are needed.
+    """
+
+    def __init__(self, answers, layout: SurveyLayout):
+        """
+        :param answers: the one-hot answer matrix from
+                        survey_matrix.load_survey
+        :param layout: the SurveyLayout for the file
+        """
+        self.answers = answers
+        self.layout = layout
+        self.nrows = len(answers)
+        self.all = np.packbits(np.ones(self.nrows, dtype=bool))
+        self.columns = {}
+
+    def column(self, col):
+        if col not in self.columns:
+            self.columns[col] = np.packbits(self.answers[:, col] != 0)
+        return self.columns[col]
+
+    def answered(self, qnum):
+        """
+        :return: the bitmap of the rows with any answer to the question
+        """
+        question = self.layout[qnum]
+        bits = np.zeros_like(self.all)
+        for col in range(question.startcol, question.limitcol):
+            bits |= self.column(col)
+        return bits
+
+    def chose(self, qnum, labels):
+        """
+        :return: the bitmap of the rows with any of the answers
+        """
+        question = self.layout[qnum]
+        bits = np.zeros_like(self.all)
+        for label in labels:
+            if label not in question.answers:
+                raise ValueError(f'{qnum} has no answer "{label}". The '
+                                 f'answers are: {", ".join(question.answers)}')
+            bits |= self.column(question.startcol
+                                + question.answers.index(label))
+        return bits
+
+    def evaluate(self, node):
+        """
+        :return: the bitmap of the rows selected by the ast node
+        """
+        if isinstance(node, ast.BoolOp):
+            bits = self.evaluate(node.values[0])
+            for value in node.values[1:]:
+                if isinstance(node.op, ast.And):
+                    bits = bits & self.evaluate(value)
+                else:
+                    bits = bits | self.evaluate(value)
+            return bits
+        if isinstance(node, ast.UnaryOp):
+            # Clear the padding bits after the last row.
+            return ~self.evaluate(node.operand) & self.all
+        qnum = _question(node.left)
+        op = node.ops[0]
+        bits = self.chose(qnum, _labels(node.comparators[0]))
+        if isinstance(op, (ast.NotEq, ast.NotIn)):
+            bits = self.answered(qnum) & ~bits
+        return bits
+
+
+def popcount(bits):
+    """
+    :return: the number of bits set in a packed bitmap
+    """
+    if hasattr(np, 'bitwise_count'):
+        return int(np.bitwise_count(bits).sum())
+    return int(BITCOUNTS[bits].sum())
+
+
+def segment_rows(segment: Segment, answers, layout: SurveyLayout):
+    """
+    :param segment: the Segment from parse_segment
+    :param answers: the one-hot answer matrix from survey_matrix.load_survey
+    :param layout: the SurveyLayout for the file
+    :return: a tuple of a boolean vector, True for each row in the segment,
+             and the number of rows in the segment.
+    :raises ValueError: if a question or answer is not in the file
+    """
+    for qnum in segment.questions:
+        if qnum not in layout:
+            raise ValueError(f'{qnum} is not in the file')
+    bits = Bitmaps(answers, layout).evaluate(segment.tree)
+    return (np.unpackbits(bits, count=len(answers)).astype(bool),
+            popcount(bits))
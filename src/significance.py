@@ -0,0 +1,115 @@
+"""
+significance.py - Chi-square tests of independence for crosstab tables.
+
+The tables for all the minor questions of a major question are padded with
+zeros to the same shape and stacked so that the expected counts, the
+chi-square statistics, Cramér's V and the adjusted residuals of every cell
+are computed with one set of array operations. Rows and columns with no
+responses are ignored.
+
+The p-value is the upper tail of the chi-square distribution, computed from
+the regularized incomplete gamma function so that SciPy is not needed.
+"""
+from collections import namedtuple
+import math
+
+import numpy as np
+
+# The adjusted residual beyond which a cell differs significantly from the
+# count expected if the questions were independent, at the 5% level.
+RESIDUAL_LIMIT = 1.96
+SIGNIFICANCE_LEVEL = 0.05
+
+# For each table: the chi-square statistic, the degrees of freedom, the
+# p-value and Cramér's V, NaN if the table has fewer than two non-empty rows
+# or columns, and an array of the adjusted residual of each cell.
+TableStats = namedtuple('TableStats', ('chi2', 'dof', 'pvalue', 'cramers_v',
+                                       'residuals'))
+
+
+def stack_tables(tables):
+    """
+    :param tables: a list of 2D count arrays with the same number of rows
+    :return: an int64 array of shape (tables, rows, most columns), each table
+             padded on the right with zeros
+    """
+    nrows = tables[0].shape[0] if tables else 0
+    ncols = max((table.shape[1] for table in tables), default=0)
+    stacked = np.zeros((len(tables), nrows, ncols), dtype=np.int64)
+    for n, table in enumerate(tables):
+        stacked[n, :, :table.shape[1]] = table
+    return stacked
+
+
+def chi2_sf(x, dof):
+    """
+    :return: the probability that a chi-square variable with dof degrees of
+             freedom exceeds x, the regularized upper incomplete gamma
+             function Q(dof / 2, x / 2).
+    """
+    if math.isnan(x) or dof <= 0:
+        return math.nan
+    a, x = dof / 2, x / 2
+    if x <= 0:
+        return 1.0
+    scale = math.exp(-x + a * math.log(x) - math.lgamma(a))
+    if x < a + 1:
+        # The series for the lower incomplete gamma function.
+        term = total = 1 / a
+        for n in range(1, 1000):
+            term *= x / (a + n)
+            total += term
+            if abs(term) < abs(total) * 1e-15:
+                break
+        return max(0.0, 1 - total * scale)
+    # The continued fraction for the upper incomplete gamma function,
+    # evaluated by Lentz's method.
+    tiny = 1e-300
+    b = x + 1 - a
+    c = 1 / tiny
+    d = 1 / b
+    h = d
+    for n in range(1, 1000):
+        an = -n * (n - a)
+        b += 2
+        d = an * d + b
+        d = 1 / (d if abs(d) > tiny else tiny)
+        c = b + an / c
+        c = c if abs(c) > tiny else tiny
+        h *= d * c
+        if abs(d * c - 1) < 1e-15:
+            break
+    return scale * h
+
+
+def table_stats(tables) -> TableStats:
+    """
+    :param tables: an array of shape (tables, rows, columns) from
+                   stack_tables
+    :return: the TableStats of the tables
+    """
+    tables = np.asarray(tables, dtype=np.float64)
+    rowtotals = tables.sum(axis=2, keepdims=True)
+    coltotals = tables.sum(axis=1, keepdims=True)
+    n = rowtotals.sum(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = rowtotals * coltotals / n
+        cells = np.where(expected > 0, (tables - expected) ** 2 / expected,
+                         0.0)
+        residuals = np.where(
+            expected > 0,
+            (tables - expected)
+            / np.sqrt(expected * (1 - rowtotals / n) * (1 - coltotals / n)),
+            0.0)
+    residuals = np.nan_to_num(residuals, nan=0.0, posinf=0.0, neginf=0.0)
+    nrows = (rowtotals[:, :, 0] > 0).sum(axis=1)
+    ncols = (coltotals[:, 0, :] > 0).sum(axis=1)
+    dof = (nrows - 1) * (ncols - 1)
+    tested = dof > 0
+    chi2 = np.where(tested, cells.sum(axis=(1, 2)), np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cramers_v = np.sqrt(chi2 / (n[:, 0, 0]
+                                    * (np.minimum(nrows, ncols) - 1)))
+    pvalue = np.array([chi2_sf(x, k) for x, k in zip(chi2.tolist(),
+                                                     dof.tolist())])
+    return TableStats(chi2, dof, pvalue, cramers_v, residuals)
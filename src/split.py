@@ -21,20 +21,26 @@
     The new questions will occupy the same columns as the previous compound
     question.
 
+    Only the three header rows are changed, so the data rows are copied as
+    bytes without being parsed.
+
 """
 
 import argparse
 import codecs
 from collections import namedtuple, OrderedDict
 import csv
+import io
 import re
 import sys
 
 from config import SKIPCOLS, SHORTSURVEY
+from survey_layout import SurveyLayout
 
 SPLIT_QUESTIONS = ('q1', ) if SHORTSURVEY else ('q9', )
 splitpat = re.compile(r'(.*) - (.*)')
 Qinfo = namedtuple('Qinfo', ('ix', 'len'))
+BUFSIZE = 1 << 20  # bytes copied at a time
 
 
 def trace(level, template, *arglist):
@@ -50,16 +56,12 @@ def get_question_dict(qrow):
             (ix, len) where ix is the offset to the start of the question and
             length is the number of answers to each question
     """
-    # qnlist is [('q1', index1), ('q2', index2), ...]
-    qnlist = [(qrow[i], i) for i in range(SKIPCOLS, len(qrow))
-              if qrow[i]]
-    qnlist.append(('qx', len(qrow)))  # append dummy entry
-    trace(2, 'qnlist: {}', qnlist)
+    layout = SurveyLayout(qrow, skipcols=SKIPCOLS)
     qdict = OrderedDict()
-    tup: tuple
-    for i, tup in enumerate(qnlist[:-1]):  # tup is (q1, index1)
-        limit = qnlist[i + 1][1]  # next question's column
-        qdict[tup[0]] = Qinfo(tup[1], limit - tup[1])
+    for question in layout:
+        qdict[question.qnum] = Qinfo(question.startcol,
+                                     question.limitcol - question.startcol)
+    trace(2, 'qdict: {}', qdict)
     return qdict
 
 
@@ -93,17 +95,59 @@ def split_question(q, r1, r2, r3, qdict):
     return None
 
 
+def read_header(infile):
+    """
+    :param infile: the input file opened in binary mode, positioned after the
+                   byte order mark if there is one
+    :return: a tuple of the list of the first three rows and the line
+             terminator of the third row, "\n" or "\r\n". The file is left
+             positioned at the start of the fourth row.
+    """
+    lastline = [b'\r\n']
+
+    def lines():
+        # A line cannot end inside a UTF-8 character, so the lines can be
+        # decoded one at a time. The reader only asks for the lines of the
+        # rows it returns.
+        for line in iter(infile.readline, b''):
+            lastline[0] = line
+            yield line.decode()
+    reader = csv.reader(lines())
+    rows = [next(reader) for _ in range(3)]
+    if lastline[0].endswith(b'\r\n') or not lastline[0].endswith(b'\n'):
+        return rows, '\r\n'
+    return rows, '\n'
+
+
+def copy_body(infile, outfile):
+    """
+    Copy the rest of the input file to the output file unchanged.
+
+    :raises UnicodeDecodeError: if the input file is not UTF-8, which the
+                                output file is declared to be by its byte
+                                order mark
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    while chunk := infile.read(BUFSIZE):
+        decoder.decode(chunk)
+        outfile.write(chunk)
+    decoder.decode(b'', final=True)
+
+
 def main():
-    reader = csv.reader(infile)
-    writer = csv.writer(outfile)
+    infile = open(args.infile, 'rb')
+    outfile = open(args.outfile, 'wb')
+    if infile.read(len(codecs.BOM_UTF8)) != codecs.BOM_UTF8:
+        infile.seek(0)
 
     # row 1: has values like q1,,,,q2,,,q3,,etc.
-    q_row = next(reader)
-    trace(2, 'q_row(len {}): {}', len(q_row), q_row)
     # row 2: contains question text in cols under question #'s
-    question_text_row = next(reader)
     # row 3: contains question answers
-    answer_text_row = next(reader)
+    # The header is written with the input's line terminator so that the
+    # rows copied unchanged do not end differently.
+    (q_row, question_text_row, answer_text_row), lineterminator = (
+        read_header(infile))
+    trace(2, 'q_row(len {}): {}', len(q_row), q_row)
 
     # question_dict: question # -> (column index, length)
     question_dict = get_question_dict(q_row)
@@ -114,15 +158,19 @@ def main():
     for question in question_dict:
         if question in SPLIT_QUESTIONS:
             split_question(question, nq_row, nq_row2, na_row, question_dict)
+    header = io.StringIO()
+    writer = csv.writer(header, lineterminator=lineterminator)
     trace(2, 'nq_row(len {}): {}', len(nq_row), nq_row)
     writer.writerow(nq_row)
     trace(2, 'nq_row2(len {}): {}', len(nq_row2), nq_row2)
     writer.writerow(nq_row2)
     writer.writerow(na_row)  # write row 3 with the split answers
+    outfile.write(codecs.BOM_UTF8 + header.getvalue().encode())
 
     # rows 4-n: the survey records
-    for row in reader:
-        writer.writerow(row)
+    copy_body(infile, outfile)
+    infile.close()
+    outfile.close()
 
 
 def getargs():
@@ -147,7 +195,5 @@ if __name__ == '__main__':
     if len(sys.argv) == 1:
         sys.argv.append('-h')
     args = getargs()
-    infile = codecs.open(args.infile, 'r', 'utf-8-sig')
-    outfile = codecs.open(args.outfile, 'w', 'utf-8-sig')
     main()
     print('End split.')
@@ -0,0 +1,145 @@
+"""
+survey_cube.py - A daily count cube for date-range crosstabs.
+
+For each major question the cube holds the running total, day by day, of the
+(major answer x column) counts computed by crosstabs5, restricted to the
+columns of the major and minor questions. The count for any range of days is
+then the difference of two entries, so a report for a date range costs
+O(days) to locate the range rather than O(responses) to count it.
+
+The cube is stored as a compressed .npz file next to the CSV file it was
+built from, along with the header rows, so that a report can be produced
+without reading the CSV file again. It is keyed by the SHA-256 of the CSV file
+and the options that change the counts and is rebuilt if either changes. The
+size and modification time of the CSV file are stored with the digest, which
+is only computed again when they change, so a report does not read the CSV
+file at all.
+"""
+from collections import namedtuple
+import json
+import os
+
+import numpy as np
+
+# Increment if the layout of the cube file changes.
+CUBE_VERSION = 2
+CUBE_SUFFIX = '.cube.npz'
+
+# header:   a dict of the three header rows, as in survey_matrix.SurveyMatrix
+# days:     the sorted distinct days with responses, a datetime64[D] array
+# base:     the running total of the rows up to each day; base[n] is the
+#           number of rows before days[n]
+# columns:  a dict mapping major question to the columns in its counts
+# counts:   a dict mapping major question to the running total of its
+#           counts, an array of shape (days + 1, major answers, columns)
+# digest:   the SHA-256 of the CSV file
+# stamp:    the file_stamp of the CSV file when the digest was computed
+Cube = namedtuple('Cube', ('key', 'header', 'days', 'base', 'columns',
+                           'counts', 'digest', 'stamp'),
+                  defaults=('', ''))
+
+
+def cube_path(filename):
+    """
+    :return: the name of the cube file for a CSV file, like 2023.cube.npz for
+             2023.csv
+    """
+    return os.path.splitext(filename)[0] + CUBE_SUFFIX
+
+
+def file_stamp(filename):
+    """
+    :return: the size and modification time of the file as a string. If they
+             are unchanged the file is assumed to be unchanged.
+    """
+    st = os.stat(filename)
+    return f'{st.st_size} {st.st_mtime_ns}'
+
+
+def day_crosstab(xmajor, rowdays, ndays, answers):
+    """
+    Compute the (day x major answer x column) count tensor. The days are too
+    many for a matrix product per time cell as crosstab_engine.year_crosstab
+    does after sorting the rows by cell, so the rows with each major answer
+    are sorted by day and each day's rows summed with reduceat.
+
+    :param xmajor: a boolean array of the major answers of each row counted
+    :param rowdays: the index into the cube days of each row's day
+    :param ndays: the number of days in the cube
+    :param answers: the one-hot answer columns to count
+    :return: an int32 array of shape (days, major answers, columns)
+    """
+    nmajor = xmajor.shape[1]
+    tensor = np.zeros((ndays, nmajor, answers.shape[1]), dtype=np.int32)
+    order = np.argsort(rowdays, kind='stable')
+    for ix in range(nmajor):
+        rows = order[xmajor[order, ix]]
+        if not len(rows):
+            continue
+        days = rowdays[rows]
+        starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+        tensor[days[starts], ix] = np.add.reduceat(answers[rows], starts,
+                                                   axis=0, dtype=np.int32)
+    return tensor
+
+
+def running_total(daily):
+    """
+    :return: the running total of an array over its first axis with a row of
+             zeros before the first day.
+    """
+    total = np.zeros((len(daily) + 1,) + daily.shape[1:], dtype=np.int32)
+    np.cumsum(daily, axis=0, out=total[1:])
+    return total
+
+
+def range_sums(total, bounds):
+    """
+    :param total: an array from running_total
+    :param bounds: the offsets into the cube days of the first day of each
+                   range followed by the offset after the last day of the
+                   last range
+    :return: the sum over each range as int64
+    """
+    bounds = np.asarray(bounds)
+    return (total[bounds[1:]].astype(np.int64)
+            - total[bounds[:-1]].astype(np.int64))
+
+
+def write_cube(cube: Cube, filename):
+    """
+    Write the cube to a temporary file and rename it so that a partly
+    written cube is never used.
+    """
+    arrays = {'key': np.array(cube.key),
+              'header': np.array(json.dumps(cube.header)),
+              'digest': np.array(cube.digest),
+              'stamp': np.array(cube.stamp),
+              'days': cube.days,
+              'base': cube.base,
+              'questions': np.array(list(cube.counts))}
+    for question in cube.counts:
+        arrays[f'columns_{question}'] = cube.columns[question]
+        arrays[f'counts_{question}'] = cube.counts[question]
+    # savez adds .npz to a name that does not end with it.
+    tempname = filename + '.tmp.npz'
+    np.savez_compressed(tempname, **arrays)
+    os.replace(tempname, filename)
+
+
+def read_cube(filename):
+    """
+    :return: the Cube in the file or None if it does not exist
+    """
+    if not os.path.exists(filename):
+        return None
+    with np.load(filename) as arrays:
+        questions = arrays['questions'].tolist()
+        return Cube(str(arrays['key']), json.loads(str(arrays['header'])),
+                    arrays['days'], arrays['base'],
+                    {question: arrays[f'columns_{question}']
+                     for question in questions},
+                    {question: arrays[f'counts_{question}']
+                     for question in questions},
+                    *(str(arrays[name]) if name in arrays.files else ''
+                      for name in ('digest', 'stamp')))
@@ -0,0 +1,74 @@
+"""
+survey_layout.py - The column layout of the questions in a CSV file.
+
+A SurveyLayout is built once from the header rows of the CSV file. It maps
+each question number to a QuestionLayout giving the question's first column,
+the first column of the next question, the question text and a tuple of the
+answer labels. Lookups are O(1) and the QuestionLayouts are immutable so they
+can be shared by everything that needs them.
+"""
+from collections import namedtuple
+
+from assign_nums import num_dict
+from config import SKIPCOLS
+
+# qnum:     the question number as it appears in row 1, like 'q13'
+# startcol: the zero based column of the question's first answer
+# limitcol: the column after the question's last answer. For example, if our
+#           question is q13, limitcol is q14's column number.
+# qtext:    the question text from row 2
+# answers:  a tuple of the answer labels from row 3
+QuestionLayout = namedtuple('QuestionLayout', ('qnum', 'startcol', 'limitcol',
+                                               'qtext', 'answers'))
+
+
+class SurveyLayout:
+
+    def __init__(self, question_row, question_text_row=None,
+                 answer_text_row=None, skipcols=SKIPCOLS):
+        """
+        :param question_row: row 1 which has values like q1,,,,q2,,,q3,,etc.
+        :param question_text_row: row 2. If omitted, qtext is ''.
+        :param answer_text_row: row 3. If omitted, answers is empty.
+        :param skipcols: the number of fixed columns before the first question
+        """
+        # map question number (like 'Q4') to column
+        qdict = num_dict(question_row, skipcols)
+        startcols = list(qdict.values())
+        # The last question extends to the end of the row.
+        limitcols = startcols[1:] + [len(question_row)]
+        self.questions = {}
+        # offsets - maps the question number to its position in column order
+        self.offsets = {qnum: n for n, qnum in enumerate(qdict)}
+        for qnum, startcol, limitcol in zip(qdict, startcols, limitcols):
+            qtext = question_text_row[startcol] if question_text_row else ''
+            answers = (tuple(answer_text_row[startcol:limitcol])
+                       if answer_text_row else ())
+            self.questions[qnum] = QuestionLayout(question_row[startcol],
+                                                  startcol, limitcol, qtext,
+                                                  answers)
+
+    def __getitem__(self, qnum) -> QuestionLayout:
+        """
+        :param qnum: the question number in either case, like 'Q4' or 'q4'
+        """
+        return self.questions[qnum.upper()]
+
+    def offset(self, qnum):
+        """
+        :param qnum: the question number in either case, like 'Q4' or 'q4'
+        :return: the position of the question in column order
+        """
+        return self.offsets[qnum.upper()]
+
+    def __contains__(self, qnum):
+        return qnum.upper() in self.questions
+
+    def __iter__(self):
+        """
+        Iterate over the QuestionLayouts in column order.
+        """
+        return iter(self.questions.values())
+
+    def __len__(self):
+        return len(self.questions)
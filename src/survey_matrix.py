@@ -0,0 +1,238 @@
+"""
+survey_matrix.py - Load a CSV file produced by aggregate->split into a NumPy
+                   matrix.
+
+Each data row becomes one row of a uint8 matrix with a 1 in every answer
+column that is not empty. The matrix has the same width as the CSV file so that
+the column numbers in the question dict built by assign_nums.num_dict can be
+used directly to slice it. The columns before SKIPCOLS (RespondentID,
+StartDate, etc.) are always zero; the ones needed by the reports are kept
+as separate lists.
+
+If strip is True, a cell holding only white space counts as empty.
+
+If a list of questions is given, only their columns are read, using the
+pandas C parser if pandas is installed. The cost of parsing is then
+proportional to the questions reported rather than the width of the survey.
+
+load_survey_cached() keeps the parsed file in a cache directory, keyed by
+the SHA-256 of the CSV file and the options used to parse it. The header rows
+and fixed columns are stored as JSON and the answer matrix in column-major
+order as a .npy file which is opened with mmap, so a rerun against an
+unchanged export does not parse the CSV file again.
+"""
+import codecs
+import csv
+from collections import namedtuple
+import hashlib
+import json
+from operator import itemgetter
+import os
+import tempfile
+
+import numpy as np
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+from config import SKIPCOLS
+from survey_layout import SurveyLayout
+
+RESPONDENT_COL = 0  # RespondentID
+DATE_COL = 2  # StartDate, like '2017-12-08T19:42:01Z'
+# Increment if the cache layout or the parsing in load_survey changes.
+CACHE_VERSION = 1
+CACHE_HEADER = 'header.json'
+CACHE_ANSWERS = 'answers.npy'
+
+SurveyMatrix = namedtuple('SurveyMatrix', ('question_row',
+                                           'question_text_row',
+                                           'answer_text_row',
+                                           'respondents',
+                                           'dates',
+                                           'answers'))
+
+
+def question_columns(question_row, questions, skipcols=SKIPCOLS):
+    """
+    :param question_row: row 1 which has values like q1,,,,q2,,,q3,,etc.
+    :param questions: the question numbers to load, like ['Q2', 'Q13']
+    :param skipcols: the number of fixed columns before the first question
+    :return: a sorted list of the columns holding answers to the questions
+    """
+    layout = SurveyLayout(question_row, skipcols=skipcols)
+    columns = set()
+    for qnum in questions:
+        if qnum in layout:
+            question = layout[qnum]
+            columns.update(range(question.startcol, question.limitcol))
+    return sorted(columns)
+
+
+def read_columns(infile, anscols, strip=False):
+    """
+    Read the data rows, keeping only the RespondentID, StartDate and the
+    given answer columns. Use the pandas C parser if it is installed,
+    otherwise the csv module.
+
+    :param infile: the open CSV file positioned after the header rows
+    :param anscols: a sorted list of the answer columns to keep
+    :param strip: if True, a cell of white space is empty
+    :return: a tuple of the list of respondent IDs, the list of start dates
+             and a boolean array, True for each non-empty answer column.
+    """
+    columns = [RESPONDENT_COL, DATE_COL] + anscols
+    if pd is not None:
+        frame = pd.read_csv(infile, header=None, usecols=columns, dtype=str,
+                            na_filter=False)
+        # Short rows give NaN in the missing columns.
+        cells = frame.reindex(columns=columns).fillna('').to_numpy()
+        anscells = cells[:, 2:]
+        if strip:
+            anscells = np.char.strip(anscells.astype(str))
+        return (cells[:, 0].tolist(), cells[:, 1].tolist(), anscells != '')
+    getter = itemgetter(*anscols)
+    respondents, dates, cells = [], [], []
+    for row in csv.reader(infile):
+        if len(row) <= columns[-1]:
+            row += [''] * (columns[-1] + 1 - len(row))
+        respondents.append(row[RESPONDENT_COL])
+        dates.append(row[DATE_COL])
+        cells.append(getter(row))
+    if strip:
+        flags = np.fromiter((cell.strip() != '' for row in cells
+                             for cell in row),
+                            dtype=bool, count=len(cells) * len(anscols))
+    else:
+        flags = np.fromiter((cell != '' for row in cells for cell in row),
+                            dtype=bool, count=len(cells) * len(anscols))
+    return respondents, dates, flags.reshape(len(cells), len(anscols))
+
+
+def load_survey(infile, skipcols=SKIPCOLS, questions=None,
+                strip=False) -> SurveyMatrix:
+    """
+    :param infile: the open CSV file
+    :param skipcols: the number of fixed columns before the first question
+    :param questions: if given, only the answer columns of these questions
+                      are read. The other columns of the matrix are zero.
+    :param strip: if True, a cell holding only white space counts as empty
+    :return: a SurveyMatrix containing the three header rows, the
+             respondent IDs, the start dates and the one-hot answer matrix
+             of shape (number of data rows, number of columns).
+    """
+    reader = csv.reader(infile)
+    question_row = next(reader)  # has values like q1,,,,q2,,,q3,,etc.
+    question_text_row = next(reader)
+    answer_text_row = next(reader)
+    ncols = len(answer_text_row)
+    if questions is None:
+        rows = list(reader)
+        respondents = [row[RESPONDENT_COL] for row in rows]
+        dates = [row[DATE_COL] for row in rows]
+        answers = np.zeros((len(rows), ncols), dtype=np.uint8)
+        for n, row in enumerate(rows):
+            limit = min(len(row), ncols)
+            answers[n, skipcols:limit] = [
+                (cell.strip() if strip else cell) != ''
+                for cell in row[skipcols:limit]]
+        return SurveyMatrix(question_row, question_text_row, answer_text_row,
+                            respondents, dates, answers)
+
+    anscols = question_columns(question_row, questions, skipcols)
+    respondents, dates, flags = read_columns(infile, anscols, strip)
+    answers = np.zeros((len(dates), ncols), dtype=np.uint8)
+    answers[:, anscols] = flags
+    return SurveyMatrix(question_row, question_text_row, answer_text_row,
+                        respondents, dates, answers)
+
+
+def answered_questions(answers, layout: SurveyLayout):
+    """
+    OR-reduce each question's slice of the answer matrix.
+
+    :param answers: the one-hot answer matrix from load_survey
+    :param layout: the SurveyLayout for the file
+    :return: a boolean array of shape (rows, questions), True where the row
+             has at least one answer to the question. The questions are in
+             column order; use layout.offset() to find a question's column.
+    """
+    startcols = [question.startcol for question in layout]
+    if not startcols or not len(answers):
+        return np.zeros((len(answers), len(startcols)), dtype=bool)
+    return np.logical_or.reduceat(answers, startcols, axis=1).astype(bool)
+
+
+def file_digest(filename):
+    """
+    :param filename: the file to hash
+    :return: the hex SHA-256 digest of the file's contents
+    """
+    with open(filename, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def cache_key(filename, skipcols=SKIPCOLS, questions=None, strip=False):
+    """
+    :return: the name of the cache entry for this file parsed with these
+             options.
+    """
+    options = (f'{CACHE_VERSION},{skipcols},{questions},'
+               f'{file_digest(filename)}')
+    if strip:
+        options += ',strip'  # the keys without strip are unchanged
+    return hashlib.sha256(options.encode()).hexdigest()
+
+
+def write_cache(survey: SurveyMatrix, cachepath):
+    """
+    Write the cache entry to a temporary directory and rename it so that a
+    partly written entry is never used.
+    """
+    cachedir = os.path.dirname(cachepath)
+    os.makedirs(cachedir, exist_ok=True)
+    tempdir = tempfile.mkdtemp(dir=cachedir)
+    header = {field: getattr(survey, field)
+              for field in SurveyMatrix._fields if field != 'answers'}
+    with open(os.path.join(tempdir, CACHE_HEADER), 'w') as f:
+        json.dump(header, f)
+    np.save(os.path.join(tempdir, CACHE_ANSWERS),
+            np.asfortranarray(survey.answers))
+    try:
+        os.rename(tempdir, cachepath)
+    except OSError:
+        # Another process created the same entry first.
+        for name in os.listdir(tempdir):
+            os.remove(os.path.join(tempdir, name))
+        os.rmdir(tempdir)
+
+
+def read_cache(cachepath) -> SurveyMatrix:
+    with open(os.path.join(cachepath, CACHE_HEADER)) as f:
+        header = json.load(f)
+    answers = np.load(os.path.join(cachepath, CACHE_ANSWERS), mmap_mode='r')
+    return SurveyMatrix(answers=answers, **header)
+
+
+def load_survey_cached(filename, cachedir, skipcols=SKIPCOLS,
+                       questions=None, strip=False) -> SurveyMatrix:
+    """
+    Like load_survey() but use the cache entry for this file if one exists,
+    otherwise parse the file and create the entry.
+
+    :param filename: the name of the CSV file produced by aggregate->split
+    :param cachedir: the directory holding the cache entries
+    :param skipcols: the number of fixed columns before the first question
+    :param questions: if given, only the columns of these questions are read
+    :param strip: if True, a cell holding only white space counts as empty
+    :return: the SurveyMatrix
+    """
+    cachepath = os.path.join(cachedir,
+                             cache_key(filename, skipcols, questions, strip))
+    if os.path.isdir(cachepath):
+        return read_cache(cachepath)
+    with codecs.open(filename, 'r', 'utf-8-sig') as infile:
+        survey = load_survey(infile, skipcols, questions, strip)
+    write_cache(survey, cachepath)
+    return survey